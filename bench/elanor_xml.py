@@ -0,0 +1,74 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+# Compare tree based and streaming extraction of contract history items.
+#
+# Usage: python3 bench/elanor_xml.py [items]
+#        python3 bench/elanor_xml.py --file pichator.dbm --tag column --attr name
+
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+from time import perf_counter
+import sys
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from pichator.elanor import iter_attrs
+
+
+def make_history(count):
+    items = ''.join(
+        '<uv_sjed_tyd hodnota="{}.0" id="{}" datum_od="2000-01-01" '
+        'datum_do="2099-12-31"/>'.format(20 + i % 21, i)
+        for i in range(count))
+    return '<pv><hist>{}</hist></pv>'.format(items)
+
+
+def tree(xml, tag, names):
+    root = ET.fromstring(xml)
+    return [tuple(el.attrib[n] for n in names) for el in root.iter(tag)]
+
+
+def stream(xml, tag, names):
+    return list(iter_attrs(xml, tag, names))
+
+
+def measure(fn, *args, rounds=5):
+    best = float('inf')
+    for _ in range(rounds):
+        start = perf_counter()
+        fn(*args)
+        best = min(best, perf_counter() - start)
+
+    tracemalloc.start()
+    result = fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak, len(result)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('items', type=int, nargs='?', default=50000)
+    parser.add_argument('--file')
+    parser.add_argument('--tag', default='uv_sjed_tyd')
+    parser.add_argument('--attr', action='append')
+    args = parser.parse_args()
+
+    names = args.attr or ['hodnota', 'datum_od', 'datum_do']
+
+    if args.file:
+        with open(args.file, encoding='utf8') as fp:
+            xml = fp.read()
+    else:
+        xml = make_history(args.items)
+
+    print('document: {:.1f} KiB'.format(len(xml) / 1024))
+
+    for fn in (tree, stream):
+        secs, peak, found = measure(fn, xml, args.tag, names)
+        print('{:<8} {:>8.2f} ms {:>10.1f} KiB peak {:>8} items'.format(
+            fn.__name__, secs * 1000, peak / 1024, found))
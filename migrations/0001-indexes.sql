@@ -0,0 +1,38 @@
+-- Indexes for the range based queries of the Manager.
+--
+-- Apply with: psql -v ON_ERROR_STOP=1 -f migrations/0001-indexes.sql pichator
+-- and verify with: python3 migrations/check-indexes.py -c config/pichator-prod.ini
+
+BEGIN;
+
+-- Presence is merged by (uid_employee, date), keep only the newest
+-- row of every employee and day before making the pair unique.
+DELETE FROM public.presence AS p
+USING public.presence AS newer
+WHERE newer.uid_employee = p.uid_employee
+  AND newer.date = p.date
+  AND newer.presid > p.presid;
+
+CREATE UNIQUE INDEX IF NOT EXISTS presence_uq ON public.presence
+	USING btree (uid_employee, date);
+
+-- pv.validity && daterange, pv.validity @> date
+CREATE INDEX IF NOT EXISTS pv_validity_idx ON public.pv
+	USING gist (validity);
+
+-- CAST(pv.department AS varchar) LIKE 'prefix%'
+CREATE INDEX IF NOT EXISTS pv_department_pattern_idx ON public.pv
+	USING btree ((CAST(department AS character varying)) varchar_pattern_ops);
+
+CREATE INDEX IF NOT EXISTS pv_uid_employee_idx ON public.pv
+	USING btree (uid_employee);
+
+CREATE INDEX IF NOT EXISTS timetable_uid_pv_idx ON public.timetable
+	USING btree (uid_pv);
+
+CREATE INDEX IF NOT EXISTS acls_dept_idx ON public.acls
+	USING btree (dept);
+
+COMMIT;
+
+ANALYZE public.presence, public.pv, public.timetable, public.employee, public.acls;
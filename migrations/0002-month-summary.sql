@@ -0,0 +1,23 @@
+-- Materialized monthly attendance summary of every pv, filled lazily
+-- by the Manager for closed months and refreshed on every change.
+--
+-- Apply with: psql -v ON_ERROR_STOP=1 -f migrations/0002-month-summary.sql pichator
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.month_summary(
+	uid_pv bigint NOT NULL,
+	month date NOT NULL,
+	symbols character varying[],
+	auto_symbols character varying[],
+	worked_minutes integer NOT NULL DEFAULT 0,
+	food_stamps smallint NOT NULL DEFAULT 0,
+	CONSTRAINT month_summary_pk PRIMARY KEY (uid_pv,month),
+	CONSTRAINT pv_fk FOREIGN KEY (uid_pv)
+		REFERENCES public.pv (uid) MATCH FULL
+		ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+ALTER TABLE public.month_summary OWNER TO pichator;
+
+COMMIT;
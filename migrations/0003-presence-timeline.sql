@@ -0,0 +1,12 @@
+-- Worked minutes and number of in/out intervals of presence as
+-- reconstructed from all badge passes of the day. Both stay NULL for
+-- presence entered by hand or synced before.
+--
+-- Apply with: psql -v ON_ERROR_STOP=1 -f migrations/0003-presence-timeline.sql pichator
+
+BEGIN;
+
+ALTER TABLE public.presence ADD COLUMN IF NOT EXISTS worked_minutes integer;
+ALTER TABLE public.presence ADD COLUMN IF NOT EXISTS intervals smallint;
+
+COMMIT;
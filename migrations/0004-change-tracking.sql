@@ -0,0 +1,94 @@
+-- Modification stamps of tracked tables and a log of changed rows,
+-- both maintained by triggers, see Manager.changed_since.
+--
+-- Apply with: psql -v ON_ERROR_STOP=1 -f migrations/0004-change-tracking.sql pichator
+
+BEGIN;
+
+ALTER TABLE public.presence ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+ALTER TABLE public.pv ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+ALTER TABLE public.timetable ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+ALTER TABLE public.acls ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+
+CREATE TABLE IF NOT EXISTS public.changelog(
+	id bigserial NOT NULL,
+	table_name character varying NOT NULL,
+	row_id bigint NOT NULL,
+	op character(1) NOT NULL,
+	changed_at timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT changelog_pk PRIMARY KEY (id)
+);
+
+ALTER TABLE public.changelog OWNER TO pichator;
+
+CREATE INDEX IF NOT EXISTS changelog_table_changed_at_idx ON public.changelog
+	USING btree (table_name, changed_at);
+
+CREATE OR REPLACE FUNCTION public.set_updated_at ()
+	RETURNS trigger
+	LANGUAGE plpgsql
+	AS $$
+BEGIN
+	NEW.updated_at = now();
+	RETURN NEW;
+END
+$$;
+
+ALTER FUNCTION public.set_updated_at() OWNER TO pichator;
+
+CREATE OR REPLACE FUNCTION public.log_change ()
+	RETURNS trigger
+	LANGUAGE plpgsql
+	AS $$
+DECLARE
+	changed jsonb;
+BEGIN
+	-- Primary key column is passed as the trigger argument
+	IF TG_OP = 'DELETE' THEN
+		changed = to_jsonb(OLD);
+	ELSE
+		changed = to_jsonb(NEW);
+	END IF;
+
+	INSERT INTO public.changelog (table_name, row_id, op)
+	VALUES (TG_TABLE_NAME, (changed ->> TG_ARGV[0])::bigint, left(TG_OP, 1));
+
+	RETURN NULL;
+END
+$$;
+
+ALTER FUNCTION public.log_change() OWNER TO pichator;
+
+DROP TRIGGER IF EXISTS presence_updated_at ON public.presence;
+CREATE TRIGGER presence_updated_at BEFORE UPDATE ON public.presence
+	FOR EACH ROW EXECUTE PROCEDURE public.set_updated_at();
+
+DROP TRIGGER IF EXISTS presence_changelog ON public.presence;
+CREATE TRIGGER presence_changelog AFTER INSERT OR DELETE OR UPDATE ON public.presence
+	FOR EACH ROW EXECUTE PROCEDURE public.log_change('presid');
+
+DROP TRIGGER IF EXISTS pv_updated_at ON public.pv;
+CREATE TRIGGER pv_updated_at BEFORE UPDATE ON public.pv
+	FOR EACH ROW EXECUTE PROCEDURE public.set_updated_at();
+
+DROP TRIGGER IF EXISTS pv_changelog ON public.pv;
+CREATE TRIGGER pv_changelog AFTER INSERT OR DELETE OR UPDATE ON public.pv
+	FOR EACH ROW EXECUTE PROCEDURE public.log_change('uid');
+
+DROP TRIGGER IF EXISTS timetable_updated_at ON public.timetable;
+CREATE TRIGGER timetable_updated_at BEFORE UPDATE ON public.timetable
+	FOR EACH ROW EXECUTE PROCEDURE public.set_updated_at();
+
+DROP TRIGGER IF EXISTS timetable_changelog ON public.timetable;
+CREATE TRIGGER timetable_changelog AFTER INSERT OR DELETE OR UPDATE ON public.timetable
+	FOR EACH ROW EXECUTE PROCEDURE public.log_change('timeid');
+
+DROP TRIGGER IF EXISTS acls_updated_at ON public.acls;
+CREATE TRIGGER acls_updated_at BEFORE UPDATE ON public.acls
+	FOR EACH ROW EXECUTE PROCEDURE public.set_updated_at();
+
+DROP TRIGGER IF EXISTS acls_changelog ON public.acls;
+CREATE TRIGGER acls_changelog AFTER INSERT OR DELETE OR UPDATE ON public.acls
+	FOR EACH ROW EXECUTE PROCEDURE public.log_change('uid');
+
+COMMIT;
@@ -0,0 +1,16 @@
+-- Fingerprints of the Elanor contracts last stored by the Manager, so
+-- that only contracts changed since the previous sync are parsed.
+--
+-- Apply with: psql -v ON_ERROR_STOP=1 -f migrations/0005-pv-source.sql pichator
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.pv_source(
+	oscpv character varying NOT NULL,
+	fingerprint character varying NOT NULL,
+	CONSTRAINT pv_source_pk PRIMARY KEY (oscpv)
+);
+
+ALTER TABLE public.pv_source OWNER TO pichator;
+
+COMMIT;
@@ -0,0 +1,58 @@
+-- Changelog is followed by entry id rather than by time, and entries of
+-- presence carry the day they belong to, deleted rows included.
+--
+-- Apply with: psql -v ON_ERROR_STOP=1 -f migrations/0006-changelog-cursor.sql pichator
+
+BEGIN;
+
+ALTER TABLE public.changelog ADD COLUMN IF NOT EXISTS row_date date;
+
+DROP INDEX IF EXISTS public.changelog_table_changed_at_idx;
+
+CREATE INDEX IF NOT EXISTS changelog_table_id_idx ON public.changelog
+	USING btree (table_name, id);
+
+CREATE INDEX IF NOT EXISTS changelog_changed_at_idx ON public.changelog
+	USING btree (changed_at);
+
+CREATE OR REPLACE FUNCTION public.log_change ()
+	RETURNS trigger
+	LANGUAGE plpgsql
+	AS $$
+DECLARE
+	changed jsonb;
+	original jsonb;
+BEGIN
+	-- Primary key column and optionally the column with the day the row
+	-- belongs to are passed as the trigger arguments
+	IF TG_OP = 'DELETE' THEN
+		changed = to_jsonb(OLD);
+	ELSE
+		changed = to_jsonb(NEW);
+	END IF;
+
+	INSERT INTO public.changelog (table_name, row_id, row_date, op)
+	VALUES (TG_TABLE_NAME, (changed ->> TG_ARGV[0])::bigint,
+	        CASE WHEN TG_NARGS > 1 THEN (changed ->> TG_ARGV[1])::date END,
+	        left(TG_OP, 1));
+
+	-- Row moved to another day, the original one has changed too
+	IF TG_OP = 'UPDATE' AND TG_NARGS > 1 THEN
+		original = to_jsonb(OLD);
+
+		IF original ->> TG_ARGV[1] IS DISTINCT FROM changed ->> TG_ARGV[1] THEN
+			INSERT INTO public.changelog (table_name, row_id, row_date, op)
+			VALUES (TG_TABLE_NAME, (original ->> TG_ARGV[0])::bigint,
+			        (original ->> TG_ARGV[1])::date, 'U');
+		END IF;
+	END IF;
+
+	RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS presence_changelog ON public.presence;
+CREATE TRIGGER presence_changelog AFTER INSERT OR DELETE OR UPDATE ON public.presence
+	FOR EACH ROW EXECUTE PROCEDURE public.log_change('presid', 'date');
+
+COMMIT;
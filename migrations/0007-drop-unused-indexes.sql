@@ -0,0 +1,11 @@
+-- Drop indexes no query of the Manager uses. Employees are looked up in
+-- the cached directory and timetables are always selected by their pv.
+--
+-- Apply with: psql -v ON_ERROR_STOP=1 -f migrations/0007-drop-unused-indexes.sql pichator
+
+BEGIN;
+
+DROP INDEX IF EXISTS public.employee_username_idx;
+DROP INDEX IF EXISTS public.timetable_validity_idx;
+
+COMMIT;
@@ -0,0 +1,165 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+# Seed the database with synthetic data inside a transaction that is
+# rolled back afterwards and verify using EXPLAIN that the hot queries
+# of the Manager use the indexes from 0001-indexes.sql.
+#
+# Only ever run this against a local or scratch database.
+
+from getopt import gnu_getopt
+from sys import argv, exit, path
+from os.path import dirname, abspath
+from datetime import date
+from configparser import ConfigParser
+from sqlalchemy import text
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+
+from pichator.db import make_db
+from pichator.manager import Manager
+
+
+SEED = [
+    '''
+    INSERT INTO employee (first_name, last_name, emp_no, username, uid)
+    SELECT 'First' || i, 'Last' || i, (100000 + i)::varchar,
+           'user' || i, 9000000 + i
+    FROM generate_series(1, :employees) AS i
+    ''',
+    # Monthly contracts over three years, spread over 900 departments
+    '''
+    INSERT INTO pv (pvid, occupancy, department, validity, uid_employee)
+    SELECT (100000 + i) || '.' || m, 1, 100 + i % 900,
+           daterange((date '2022-01-01' + make_interval(months => m))::date,
+                     (date '2022-01-01' + make_interval(months => m + 1))::date),
+           9000000 + i
+    FROM generate_series(1, :employees) AS i, generate_series(0, 35) AS m
+    ''',
+    '''
+    INSERT INTO timetable (uid_pv, validity)
+    SELECT uid, validity FROM pv WHERE uid_employee >= 9000000
+    ''',
+    '''
+    INSERT INTO presence (date, presence_mode, arrival, departure, uid_employee)
+    SELECT date '2024-01-01' + d, 'Presence', '08:00', '16:30', 9000000 + i
+    FROM generate_series(1, :employees) AS i, generate_series(0, 89) AS d
+    ''',
+    '''
+    INSERT INTO acls (dept, acl)
+    SELECT i::varchar, 'edit' FROM generate_series(1, 999) AS i
+    ''',
+    'ANALYZE employee, pv, timetable, presence, acls',
+]
+
+# Queries as issued by the Manager, with the index they should use.
+CHECKS = [
+    ('pv_department_pattern_idx', 'get_employees, get_department',
+     lambda manager: manager.dept_pvs_query('81', 5, 2024)),
+    ('pv_uid_employee_idx', 'get_pvs',
+     lambda manager: manager.pvs_query(9000005, 5, 2024)),
+    ('pv_validity_idx', 'get_present',
+     lambda manager: manager.present_query(date(2024, 2, 1))),
+    ('timetable_uid_pv_idx', 'get_attendance, summarize',
+     lambda manager: manager.timetables_query([1, 2, 3], 2024, 5)),
+    ('presence_uq', 'set_attendance',
+     lambda manager: manager.attendance_query(9000005, '2024-02-01')),
+    ('timetable_uid_pv_idx', 'set_timetables',
+     lambda manager: manager.current_timetable_query('100005.4', date(2022, 5, 15))),
+    ('acls_dept_idx', 'set_dept_mode',
+     lambda manager: manager.dept_mode_query('81')),
+]
+
+
+def plan_indexes(node):
+    """Collect names of all indexes used in a JSON plan node."""
+
+    found = set()
+
+    if 'Index Name' in node:
+        found.add(node['Index Name'])
+
+    for child in node.get('Plans', []):
+        found |= plan_indexes(child)
+
+    return found
+
+
+def explain(session, query):
+    """JSON plan of a query object, bound parameters included."""
+
+    compiled = query.statement.compile(dialect=session.bind.dialect)
+    cursor = session.connection().connection.cursor()
+
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params)
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def check(url, employees):
+    config = ConfigParser()
+    config.read_dict({'postgres': {'url': url}})
+
+    manager = Manager(make_db(config, 'postgres'))
+    session = manager.db.session
+    failed = 0
+
+    try:
+        for stmt in SEED:
+            session.execute(text(stmt), {'employees': employees})
+
+        for index, users, make_query in CHECKS:
+            plan = explain(session, make_query(manager))
+            used = plan_indexes(plan[0]['Plan'])
+
+            if index in used:
+                print('ok    {:<28} {}'.format(index, users))
+            else:
+                failed += 1
+                print('FAIL  {:<28} {} (uses {})'.format(
+                    index, users, ', '.join(sorted(used)) or 'no index'))
+    finally:
+        session.rollback()
+
+    return failed
+
+
+if __name__ == '__main__':
+    def do_help():
+        print('Usage: check-indexes.py [--config=config/pichator-prod.ini]')
+        print('Verifies that the Manager queries use the expected indexes.')
+        print('')
+        print('OPTIONS:')
+        print('  --help, -h            Display this help.')
+        print('  --config, -c file     Load database url from configuration file.')
+        print('  --url, -u url         Use given database url instead.')
+        print('  --employees, -n num   Number of employees to seed (2000).')
+
+    opts, args = gnu_getopt(argv, 'hc:u:n:',
+                            ['help', 'config=', 'url=', 'employees='])
+
+    config_path = 'config/pichator-prod.ini'
+    url = None
+    employees = 2000
+
+    for k, v in opts:
+        if k in ('--help', '-h'):
+            do_help()
+            exit(0)
+        elif k in ('--config', '-c'):
+            config_path = v
+        elif k in ('--url', '-u'):
+            url = v
+        elif k in ('--employees', '-n'):
+            employees = int(v)
+
+    if url is None:
+        config = ConfigParser()
+        config.read(config_path)
+        url = config.get('postgres', 'url')
+
+    exit(1 if check(url, employees) else 0)
+
+# vim:set sw=4 ts=4 et:
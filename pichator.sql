@@ -132,6 +132,9 @@ CREATE TABLE public.presence(
 	departure time NOT NULL,
 	uid_employee bigint NOT NULL,
 	food_stamp bool NOT NULL DEFAULT False,
+	worked_minutes integer,
+	intervals smallint,
+	updated_at timestamptz NOT NULL DEFAULT now(),
 	CONSTRAINT presence_pk PRIMARY KEY (presid)
 
 );
@@ -146,6 +149,16 @@ REFERENCES public.employee (uid) MATCH FULL
 ON DELETE RESTRICT ON UPDATE CASCADE;
 -- ddl-end --
 
+-- object: presence_uq | type: INDEX --
+-- DROP INDEX IF EXISTS public.presence_uq CASCADE;
+CREATE UNIQUE INDEX presence_uq ON public.presence
+	USING btree
+	(
+	  uid_employee,
+	  date
+	);
+-- ddl-end --
+
 -- object: public.pv | type: TABLE --
 -- DROP TABLE IF EXISTS public.pv CASCADE;
 CREATE TABLE public.pv(
@@ -155,6 +168,7 @@ CREATE TABLE public.pv(
 	uid bigint NOT NULL DEFAULT nextval('public.pv_pvid_seq'::regclass),
 	validity daterange NOT NULL,
 	uid_employee bigint NOT NULL,
+	updated_at timestamptz NOT NULL DEFAULT now(),
 	CONSTRAINT pv_pk PRIMARY KEY (uid)
 
 );
@@ -178,6 +192,7 @@ CREATE TABLE public.timetable(
 	wednesday_o public.timerange,
 	thursday_o public.timerange,
 	friday_o public.timerange,
+	updated_at timestamptz NOT NULL DEFAULT now(),
 	CONSTRAINT timetable_pk PRIMARY KEY (timeid)
 
 );
@@ -192,6 +207,33 @@ REFERENCES public.employee (uid) MATCH FULL
 ON DELETE RESTRICT ON UPDATE CASCADE;
 -- ddl-end --
 
+-- object: pv_validity_idx | type: INDEX --
+-- DROP INDEX IF EXISTS public.pv_validity_idx CASCADE;
+CREATE INDEX pv_validity_idx ON public.pv
+	USING gist
+	(
+	  validity
+	);
+-- ddl-end --
+
+-- object: pv_department_pattern_idx | type: INDEX --
+-- DROP INDEX IF EXISTS public.pv_department_pattern_idx CASCADE;
+CREATE INDEX pv_department_pattern_idx ON public.pv
+	USING btree
+	(
+	  (CAST(department AS character varying)) varchar_pattern_ops
+	);
+-- ddl-end --
+
+-- object: pv_uid_employee_idx | type: INDEX --
+-- DROP INDEX IF EXISTS public.pv_uid_employee_idx CASCADE;
+CREATE INDEX pv_uid_employee_idx ON public.pv
+	USING btree
+	(
+	  uid_employee
+	);
+-- ddl-end --
+
 -- object: pv_fk | type: CONSTRAINT --
 -- ALTER TABLE public.timetable DROP CONSTRAINT IF EXISTS pv_fk CASCADE;
 ALTER TABLE public.timetable ADD CONSTRAINT pv_fk FOREIGN KEY (uid_pv)
@@ -199,6 +241,15 @@ REFERENCES public.pv (uid) MATCH FULL
 ON DELETE RESTRICT ON UPDATE CASCADE;
 -- ddl-end --
 
+-- object: timetable_uid_pv_idx | type: INDEX --
+-- DROP INDEX IF EXISTS public.timetable_uid_pv_idx CASCADE;
+CREATE INDEX timetable_uid_pv_idx ON public.timetable
+	USING btree
+	(
+	  uid_pv
+	);
+-- ddl-end --
+
 -- object: public.helper_variables | type: TABLE --
 -- DROP TABLE IF EXISTS public.helper_variables CASCADE;
 CREATE TABLE public.helper_variables(
@@ -232,6 +283,7 @@ CREATE TABLE public.acls(
 	uid smallint NOT NULL DEFAULT nextval('public.acls_uid_seq'::regclass),
 	dept character varying NOT NULL,
 	acl character varying NOT NULL,
+	updated_at timestamptz NOT NULL DEFAULT now(),
 	CONSTRAINT acls_pk PRIMARY KEY (uid)
 
 );
@@ -239,4 +291,234 @@ CREATE TABLE public.acls(
 ALTER TABLE public.acls OWNER TO pichator;
 -- ddl-end --
 
+-- object: acls_dept_idx | type: INDEX --
+-- DROP INDEX IF EXISTS public.acls_dept_idx CASCADE;
+CREATE INDEX acls_dept_idx ON public.acls
+	USING btree
+	(
+	  dept
+	);
+-- ddl-end --
+
+-- object: public.pv_source | type: TABLE --
+-- DROP TABLE IF EXISTS public.pv_source CASCADE;
+CREATE TABLE public.pv_source(
+	oscpv character varying NOT NULL,
+	fingerprint character varying NOT NULL,
+	CONSTRAINT pv_source_pk PRIMARY KEY (oscpv)
+
+);
+-- ddl-end --
+ALTER TABLE public.pv_source OWNER TO pichator;
+-- ddl-end --
+
+
+
+-- object: public.month_summary | type: TABLE --
+-- DROP TABLE IF EXISTS public.month_summary CASCADE;
+CREATE TABLE public.month_summary(
+	uid_pv bigint NOT NULL,
+	month date NOT NULL,
+	symbols character varying[],
+	auto_symbols character varying[],
+	worked_minutes integer NOT NULL DEFAULT 0,
+	food_stamps smallint NOT NULL DEFAULT 0,
+	CONSTRAINT month_summary_pk PRIMARY KEY (uid_pv,month)
+
+);
+-- ddl-end --
+ALTER TABLE public.month_summary OWNER TO pichator;
+-- ddl-end --
+
+-- object: pv_fk | type: CONSTRAINT --
+-- ALTER TABLE public.month_summary DROP CONSTRAINT IF EXISTS pv_fk CASCADE;
+ALTER TABLE public.month_summary ADD CONSTRAINT pv_fk FOREIGN KEY (uid_pv)
+REFERENCES public.pv (uid) MATCH FULL
+ON DELETE CASCADE ON UPDATE CASCADE;
+-- ddl-end --
+
+-- object: public.changelog_id_seq | type: SEQUENCE --
+-- DROP SEQUENCE IF EXISTS public.changelog_id_seq CASCADE;
+CREATE SEQUENCE public.changelog_id_seq
+	INCREMENT BY 1
+	MINVALUE 0
+	MAXVALUE 9223372036854775807
+	START WITH 1
+	CACHE 1
+	NO CYCLE
+	OWNED BY NONE;
+-- ddl-end --
+ALTER SEQUENCE public.changelog_id_seq OWNER TO pichator;
+-- ddl-end --
+
+-- object: public.changelog | type: TABLE --
+-- DROP TABLE IF EXISTS public.changelog CASCADE;
+CREATE TABLE public.changelog(
+	id bigint NOT NULL DEFAULT nextval('public.changelog_id_seq'::regclass),
+	table_name character varying NOT NULL,
+	row_id bigint NOT NULL,
+	row_date date,
+	op character(1) NOT NULL,
+	changed_at timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT changelog_pk PRIMARY KEY (id)
+
+);
+-- ddl-end --
+ALTER TABLE public.changelog OWNER TO pichator;
+-- ddl-end --
+
+-- object: changelog_table_id_idx | type: INDEX --
+-- DROP INDEX IF EXISTS public.changelog_table_id_idx CASCADE;
+CREATE INDEX changelog_table_id_idx ON public.changelog
+	USING btree
+	(
+	  table_name,
+	  id
+	);
+-- ddl-end --
+
+-- object: changelog_changed_at_idx | type: INDEX --
+-- DROP INDEX IF EXISTS public.changelog_changed_at_idx CASCADE;
+CREATE INDEX changelog_changed_at_idx ON public.changelog
+	USING btree
+	(
+	  changed_at
+	);
+-- ddl-end --
+
+-- object: public.set_updated_at | type: FUNCTION --
+-- DROP FUNCTION IF EXISTS public.set_updated_at() CASCADE;
+CREATE FUNCTION public.set_updated_at ()
+	RETURNS trigger
+	LANGUAGE plpgsql
+	VOLATILE 
+	CALLED ON NULL INPUT
+	SECURITY INVOKER
+	COST 1
+	AS $$
+BEGIN
+	NEW.updated_at = now();
+	RETURN NEW;
+END
+$$;
+-- ddl-end --
+ALTER FUNCTION public.set_updated_at() OWNER TO pichator;
+-- ddl-end --
+
+-- object: public.log_change | type: FUNCTION --
+-- DROP FUNCTION IF EXISTS public.log_change() CASCADE;
+CREATE FUNCTION public.log_change ()
+	RETURNS trigger
+	LANGUAGE plpgsql
+	VOLATILE 
+	CALLED ON NULL INPUT
+	SECURITY INVOKER
+	COST 1
+	AS $$
+DECLARE
+	changed jsonb;
+	original jsonb;
+BEGIN
+	-- Primary key column and optionally the column with the day the row
+	-- belongs to are passed as the trigger arguments
+	IF TG_OP = 'DELETE' THEN
+		changed = to_jsonb(OLD);
+	ELSE
+		changed = to_jsonb(NEW);
+	END IF;
+
+	INSERT INTO public.changelog (table_name, row_id, row_date, op)
+	VALUES (TG_TABLE_NAME, (changed ->> TG_ARGV[0])::bigint,
+	        CASE WHEN TG_NARGS > 1 THEN (changed ->> TG_ARGV[1])::date END,
+	        left(TG_OP, 1));
+
+	-- Row moved to another day, the original one has changed too
+	IF TG_OP = 'UPDATE' AND TG_NARGS > 1 THEN
+		original = to_jsonb(OLD);
+
+		IF original ->> TG_ARGV[1] IS DISTINCT FROM changed ->> TG_ARGV[1] THEN
+			INSERT INTO public.changelog (table_name, row_id, row_date, op)
+			VALUES (TG_TABLE_NAME, (original ->> TG_ARGV[0])::bigint,
+			        (original ->> TG_ARGV[1])::date, 'U');
+		END IF;
+	END IF;
+
+	RETURN NULL;
+END
+$$;
+-- ddl-end --
+ALTER FUNCTION public.log_change() OWNER TO pichator;
+-- ddl-end --
+
+-- object: presence_updated_at | type: TRIGGER --
+-- DROP TRIGGER IF EXISTS presence_updated_at ON public.presence CASCADE;
+CREATE TRIGGER presence_updated_at
+	BEFORE UPDATE
+	ON public.presence
+	FOR EACH ROW
+	EXECUTE PROCEDURE public.set_updated_at();
+-- ddl-end --
+
+-- object: presence_changelog | type: TRIGGER --
+-- DROP TRIGGER IF EXISTS presence_changelog ON public.presence CASCADE;
+CREATE TRIGGER presence_changelog
+	AFTER INSERT OR DELETE OR UPDATE
+	ON public.presence
+	FOR EACH ROW
+	EXECUTE PROCEDURE public.log_change('presid','date');
+-- ddl-end --
+
+-- object: pv_updated_at | type: TRIGGER --
+-- DROP TRIGGER IF EXISTS pv_updated_at ON public.pv CASCADE;
+CREATE TRIGGER pv_updated_at
+	BEFORE UPDATE
+	ON public.pv
+	FOR EACH ROW
+	EXECUTE PROCEDURE public.set_updated_at();
+-- ddl-end --
+
+-- object: pv_changelog | type: TRIGGER --
+-- DROP TRIGGER IF EXISTS pv_changelog ON public.pv CASCADE;
+CREATE TRIGGER pv_changelog
+	AFTER INSERT OR DELETE OR UPDATE
+	ON public.pv
+	FOR EACH ROW
+	EXECUTE PROCEDURE public.log_change('uid');
+-- ddl-end --
+
+-- object: timetable_updated_at | type: TRIGGER --
+-- DROP TRIGGER IF EXISTS timetable_updated_at ON public.timetable CASCADE;
+CREATE TRIGGER timetable_updated_at
+	BEFORE UPDATE
+	ON public.timetable
+	FOR EACH ROW
+	EXECUTE PROCEDURE public.set_updated_at();
+-- ddl-end --
+
+-- object: timetable_changelog | type: TRIGGER --
+-- DROP TRIGGER IF EXISTS timetable_changelog ON public.timetable CASCADE;
+CREATE TRIGGER timetable_changelog
+	AFTER INSERT OR DELETE OR UPDATE
+	ON public.timetable
+	FOR EACH ROW
+	EXECUTE PROCEDURE public.log_change('timeid');
+-- ddl-end --
+
+-- object: acls_updated_at | type: TRIGGER --
+-- DROP TRIGGER IF EXISTS acls_updated_at ON public.acls CASCADE;
+CREATE TRIGGER acls_updated_at
+	BEFORE UPDATE
+	ON public.acls
+	FOR EACH ROW
+	EXECUTE PROCEDURE public.set_updated_at();
+-- ddl-end --
+
+-- object: acls_changelog | type: TRIGGER --
+-- DROP TRIGGER IF EXISTS acls_changelog ON public.acls CASCADE;
+CREATE TRIGGER acls_changelog
+	AFTER INSERT OR DELETE OR UPDATE
+	ON public.acls
+	FOR EACH ROW
+	EXECUTE PROCEDURE public.log_change('uid');
+-- ddl-end --
 
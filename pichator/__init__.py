@@ -6,5 +6,9 @@ from pichator.manager import *
 from pichator.rbac import *
 from pichator.ekv import *
 from pichator.elanor import *
+from pichator.workdays import *
+from pichator.db import *
+from pichator.pdf import *
+from pichator.scheduler import *
 
 # vim:set sw=4 ts=4 et:
\ No newline at end of file
@@ -0,0 +1,132 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from threading import RLock, Lock
+from time import monotonic
+from hashlib import sha1
+from os import urandom
+
+__all__ = ['TTLCache', 'Versions']
+
+
+class Pending:
+    """Computation of a cache entry along with the callers waiting for it."""
+
+    __slots__ = ('lock', 'users', 'stale')
+
+    def __init__(self):
+        self.lock = RLock()
+        self.users = 0
+
+        # Invalidated during the computation, the value must not be stored.
+        self.stale = False
+
+
+class TTLCache:
+    """
+    Thread-safe cache of computed values expiring after `ttl` seconds.
+    Values are computed on demand by the callable passed to `get`, with
+    only the callers of the same key waiting for the computation.
+    Expired entries are pruned as new ones are stored.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = {}
+        self.pending = {}
+        self.next_prune = monotonic() + ttl
+
+    def fresh(self, key):
+        entry = self.entries.get(key)
+
+        if entry is not None and entry[0] >= monotonic():
+            return entry
+
+        return None
+
+    def store(self, key, value):
+        now = monotonic()
+
+        if now >= self.next_prune:
+            self.entries = {k: e for k, e in self.entries.items() if e[0] >= now}
+            self.next_prune = now + self.ttl
+
+        self.entries[key] = (now + self.ttl, value)
+
+    def get(self, key, compute, *args):
+        with self.lock:
+            entry = self.fresh(key)
+            if entry is not None:
+                return entry[1]
+
+            pending = self.pending.get(key)
+            if pending is None:
+                pending = self.pending[key] = Pending()
+
+            pending.users += 1
+
+        try:
+            with pending.lock:
+                # Someone else might have computed it while we waited.
+                with self.lock:
+                    entry = self.fresh(key)
+                    if entry is not None:
+                        return entry[1]
+
+                    pending.stale = False
+
+                value = compute(*args)
+
+                with self.lock:
+                    if not pending.stale:
+                        self.store(key, value)
+
+                return value
+        finally:
+            with self.lock:
+                pending.users -= 1
+                if not pending.users:
+                    del self.pending[key]
+
+    def invalidate(self, key=None):
+        """Drop given entry or everything when no key is given."""
+
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                for pending in self.pending.values():
+                    pending.stale = True
+            else:
+                self.entries.pop(key, None)
+                if key in self.pending:
+                    self.pending[key].stale = True
+
+
+class Versions:
+    """
+    Counters of changes made to parts of the data through this process,
+    combined into opaque tokens that change whenever any of the parts
+    they cover does. Tokens of different processes never match.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.boot = urandom(8).hex()
+
+    def bump(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.counters[key] = self.counters.get(key, 0) + 1
+
+    def token(self, *keys, scope=()):
+        """Token of given parts, further distinguished by the `scope`."""
+
+        with self.lock:
+            parts = [self.counters.get(key, 0) for key in keys]
+
+        return sha1(repr((self.boot, parts, scope)).encode('utf-8')).hexdigest()
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,73 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from functools import wraps
+from sqlsoup import SQLSoup
+
+__all__ = ['make_db', 'release_sessions', 'released', 'pool_status']
+
+
+# Engines and sessions of all configured databases by config section
+DATABASES = {}
+
+
+def make_db(config, section):
+    """
+    Prepare SQLSoup for database configured in given section, with its
+    own connection pool and a session scoped to the current thread.
+    """
+
+    engine = create_engine(
+        config.get(section, 'url'),
+        pool_size=config.getint(section, 'pool_size', fallback=5),
+        max_overflow=config.getint(section, 'max_overflow', fallback=10),
+        pool_timeout=config.getint(section, 'pool_timeout', fallback=30),
+        pool_recycle=config.getint(section, 'pool_recycle', fallback=3600),
+        pool_pre_ping=config.getboolean(section, 'pool_pre_ping', fallback=True))
+
+    session = scoped_session(sessionmaker(bind=engine, autocommit=False))
+    DATABASES[section] = (engine, session)
+
+    return SQLSoup(engine, session=session)
+
+
+def release_sessions():
+    """Close sessions of the current thread, returning their connections."""
+
+    for _, session in DATABASES.values():
+        session.remove()
+
+
+def released(fn):
+    """Release sessions of the current thread once `fn` finishes."""
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            release_sessions()
+
+    return wrapper
+
+
+def pool_status():
+    """Statistics of connection pools of all configured databases."""
+
+    status = {}
+
+    for section, (engine, _) in DATABASES.items():
+        pool = engine.pool
+        status[section] = {
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        }
+
+    return status
+
+
+# vim:set sw=4 ts=4 et:
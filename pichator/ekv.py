@@ -3,13 +3,46 @@
 
 __all__ = ['Ekv']
 
-from datetime import datetime
+from datetime import datetime, timedelta, time
+from itertools import groupby
 from twisted.python import log
 
+
+def pair_passes(passes, min_gap=timedelta(minutes=1)):
+    """
+    Pair ordered passes of a single day into `(entry, exit)` intervals,
+    taking them alternately as entries and exits. Repeated swipes within
+    `min_gap` of the previous pass are ignored and a trailing entry
+    without an exit does not make an interval.
+    """
+
+    intervals = []
+    entry = last = None
+
+    for passed in passes:
+        if last is not None and passed - last < min_gap:
+            continue
+
+        last = passed
+
+        if entry is None:
+            entry = passed
+        else:
+            intervals.append((entry, passed))
+            entry = None
+
+    return intervals
+
+
 class Ekv:
     def __init__(self, db):
         self.db = db
 
+        # High-water mark of passes seen by `get_new_passes` and first
+        # and last pass of every asset today folded from them.
+        self.mark = None
+        self.folded = {}
+
     def get_arrival(self, date, ID):
         ms_date = date.strftime("%Y-%m-%d")
         query = '''
@@ -30,4 +63,117 @@ class Ekv:
                 '''.format(ID, ms_date, ms_date)
         return self.db.execute(query).fetchall()[0][0]
 
+    def get_passes(self, date_from, date_to=None):
+        """
+        Return first and last pass of every asset for every day in the
+        range as a `{(uid, date): (arrival, departure)}` map, using a single
+        grouped query instead of one pair of queries per employee.
+        """
+
+        date_to = date_to or date_from
+        ms_from = date_from.strftime("%Y-%m-%d")
+        ms_to = (date_to + timedelta(days=1)).strftime("%Y-%m-%d")
+        query = '''
+                SELECT [AssetUID], MIN([Time]), MAX([Time])
+                FROM [ASSET].[dbo].[EFI_EKV_ValidPass]
+                WHERE [AssetUID] LIKE 'I1.%'
+                AND [Time] >= '{} 00:00:00' AND [Time] < '{} 00:00:00'
+                GROUP BY [AssetUID], CAST([Time] AS date)
+                '''.format(ms_from, ms_to)
+
+        retval = {}
+
+        for asset_uid, arrival, departure in self.db.execute(query).fetchall():
+            try:
+                uid = int(asset_uid.split('.', 1)[1])
+            except (IndexError, ValueError):
+                log.msg('Ignoring pass of unknown asset {}'.format(asset_uid))
+                continue
+
+            retval[(uid, arrival.date())] = (arrival, departure)
+
+        return retval
+
+    def get_timelines(self, date_from, date_to=None):
+        """
+        Reconstruct presence of every asset for every day in the range
+        from all its passes, fetched ordered in a single query. Returns
+        `{(uid, date): (arrival, departure, worked_minutes, intervals)}`.
+        """
+
+        date_to = date_to or date_from
+        ms_from = date_from.strftime("%Y-%m-%d")
+        ms_to = (date_to + timedelta(days=1)).strftime("%Y-%m-%d")
+        query = '''
+                SELECT [AssetUID], [Time]
+                FROM [ASSET].[dbo].[EFI_EKV_ValidPass]
+                WHERE [AssetUID] LIKE 'I1.%'
+                AND [Time] >= '{} 00:00:00' AND [Time] < '{} 00:00:00'
+                ORDER BY [AssetUID], [Time]
+                '''.format(ms_from, ms_to)
+
+        retval = {}
+        rows = self.db.execute(query)
+
+        for (asset_uid, day), passes in groupby(rows, lambda row: (row[0], row[1].date())):
+            try:
+                uid = int(asset_uid.split('.', 1)[1])
+            except (IndexError, ValueError):
+                log.msg('Ignoring pass of unknown asset {}'.format(asset_uid))
+                continue
+
+            passes = [passed for _, passed in passes]
+            intervals = pair_passes(passes)
+            worked = sum((exit - entry).total_seconds() for entry, exit in intervals)
+
+            retval[(uid, day)] = (passes[0], passes[-1], int(worked // 60), len(intervals))
+
+        return retval
+
+    def get_new_passes(self):
+        """
+        Fetch only passes recorded since the previous call and fold them
+        into first and last pass of the day. Returns entries that changed
+        in the same form as `get_passes`. The first call loads all of today.
+        """
+
+        today = datetime.now().date()
+
+        if self.mark is None:
+            self.folded = self.get_passes(today)
+            self.mark = max((departure for _, departure in self.folded.values()),
+                            default=datetime.combine(today, time()))
+            return dict(self.folded)
+
+        # Passes at the mark itself are read again, folding is idempotent
+        # and we would miss passes recorded later within the same instant.
+        query = '''
+                SELECT [AssetUID], [Time]
+                FROM [ASSET].[dbo].[EFI_EKV_ValidPass]
+                WHERE [AssetUID] LIKE 'I1.%'
+                AND [Time] >= '{}'
+                '''.format(self.mark.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3])
+
+        # Forget previous days
+        self.folded = {key: value for key, value in self.folded.items()
+                       if key[1] >= today}
+
+        changed = {}
+
+        for asset_uid, passed in self.db.execute(query).fetchall():
+            self.mark = max(self.mark, passed)
+
+            try:
+                uid = int(asset_uid.split('.', 1)[1])
+            except (IndexError, ValueError):
+                log.msg('Ignoring pass of unknown asset {}'.format(asset_uid))
+                continue
+
+            key = (uid, passed.date())
+            arrival, departure = self.folded.get(key, (passed, passed))
+            value = (min(arrival, passed), max(departure, passed))
+
+            if self.folded.get(key) != value:
+                self.folded[key] = changed[key] = value
 
+        return changed
@@ -3,7 +3,8 @@
 
 from twisted.python import log
 from datetime import date, datetime
-import xml.etree.ElementTree as ET
+from hashlib import sha1
+from xml.parsers import expat
 
 __all__ = ['Elanor']
 
@@ -12,6 +13,30 @@ def parse_date(date_str):
     return datetime.strptime(date_str, '%Y-%m-%d').date()
 
 
+def iter_attrs(xml, tag, names, chunk_size=1 << 16):
+    """
+    Yield tuples of selected attributes of every `tag` element in the
+    document. The document is fed to expat in chunks and no tree is built.
+    """
+
+    found = []
+
+    def start(name, attrs):
+        if name == tag:
+            found.append(tuple(attrs[n] for n in names))
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+
+    for offset in range(0, len(xml), chunk_size):
+        parser.Parse(xml[offset:offset + chunk_size], False)
+        yield from found
+        found.clear()
+
+    parser.Parse('', True)
+    yield from found
+
+
 class Elanor:
     def __init__(self, db):
         self.elanor_db = db
@@ -22,34 +47,64 @@ class Elanor:
         retval = []
 
         for pv in pvs:
-            xml = ET.fromstring(pv.dalsi1_xml)
-
-            for pv_item in xml.findall('.//uv_sjed_tyd'):
-                date_from = parse_date(pv_item.attrib['datum_od'])
-                date_to = parse_date(pv_item.attrib['datum_do'])
-                occupancy = round(float(pv_item.attrib['hodnota']) / 40, 2)
-                
-                dat_odd = parse_date(pv.od_std)
-                dat_ddo = parse_date(pv.do_std)
-
-                dat_nast = parse_date(pv.dat_nast)
-                dat_ukon = parse_date(pv.dat_ukon)
-
-                item = {
-                    'pvid': pv.oscpv,
-                    'occupancy': occupancy,
-                    'department': pv.kod,
-                    'validity': (max(dat_nast, date_from, dat_odd),
-                                 min(dat_ukon, date_to, dat_ddo)),
-                    'emp_no': emp_no
-                }
-
-                if item['validity'][0] > item['validity'][1]:
-                    log.msg('Ignoring {} (valid_from:{} < valid_to:{})'.format(
-                        pv.oscpv, item['validity'][0], item['validity'][1]))
-                    continue
-
-                retval.append(item)
+            retval.extend(self.get_items(pv))
 
         return retval
 
+    def get_contracts(self, part=0, parts=1):
+        """
+        Return `(oscpv, fingerprint, pv)` for every contract (optionally
+        only for the `part` out of `parts` by hash of the contract number)
+        using a single query. The fingerprint changes whenever anything
+        the contract items are parsed from changes.
+        """
+
+        query_text = "select * from pv where oscpv like '%.%'"
+
+        # Only matching rows have their XML payload read
+        if parts > 1:
+            query_text += f" and mod(ora_hash(oscpv), {int(parts)}) = {int(part)}"
+
+        return [(pv.oscpv, self.fingerprint(pv), pv)
+                for pv in self.elanor_db.execute(query_text)]
+
+    def fingerprint(self, pv):
+        payload = '\x1f'.join(str(value) for value in (
+            pv.kod, pv.od_std, pv.do_std, pv.dat_nast, pv.dat_ukon, pv.dalsi1_xml))
+        return sha1(payload.encode('utf8')).hexdigest()
+
+    def get_items(self, pv):
+        emp_no = pv.oscpv.split('.')[0]
+        retval = []
+
+        dat_odd = parse_date(pv.od_std)
+        dat_ddo = parse_date(pv.do_std)
+
+        dat_nast = parse_date(pv.dat_nast)
+        dat_ukon = parse_date(pv.dat_ukon)
+
+        items = iter_attrs(pv.dalsi1_xml, 'uv_sjed_tyd',
+                           ('hodnota', 'datum_od', 'datum_do'))
+
+        for hodnota, datum_od, datum_do in items:
+            date_from = parse_date(datum_od)
+            date_to = parse_date(datum_do)
+            occupancy = round(float(hodnota) / 40, 2)
+
+            item = {
+                'pvid': pv.oscpv,
+                'occupancy': occupancy,
+                'department': pv.kod,
+                'validity': (max(dat_nast, date_from, dat_odd),
+                             min(dat_ukon, date_to, dat_ddo)),
+                'emp_no': emp_no
+            }
+
+            if item['validity'][0] > item['validity'][1]:
+                log.msg('Ignoring {} (valid_from:{} < valid_to:{})'.format(
+                    pv.oscpv, item['validity'][0], item['validity'][1]))
+                continue
+
+            retval.append(item)
+
+        return retval
@@ -0,0 +1,232 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from datetime import date
+from calendar import monthrange
+from bisect import bisect_right
+from pichator.workdays import CZ_CALENDAR, HOLIDAY, WEEKEND, EVEN_WEEK
+
+__all__ = ['MonthGrid', 'CompiledTimetable', 'TimetableIndex',
+           'timetable_slots', 'slot_lengths', 'eng_to_symbol']
+
+
+SLOT_NAMES = (
+    'monday_e', 'tuesday_e', 'wednesday_e', 'thursday_e', 'friday_e', None, None,
+    'monday_o', 'tuesday_o', 'wednesday_o', 'thursday_o', 'friday_o', None, None,
+)
+
+
+def eng_to_symbol(mode, stamp):
+    obj_mapping = {
+        'Employer difficulties': 'C',
+        'Vacation': 'D',
+        'Vacation 0.5': '0,5D',
+        'Presence': '/' if stamp else '/-',
+        'Absence': 'A',
+        'On call time': 'H',
+        'Sickness': 'N',
+        'Compensatory time off': 'NV',
+        'Family member care': 'O',
+        'Personal trouble': 'P',
+        'Bussiness trip': 'Sc+' if stamp else 'Sc',
+        'Study': 'St',
+        'Training': 'Šk' if stamp else 'Šk-',
+        'Injury and disease from profession': 'Ú',
+        'Unpaid leave': 'V',
+        'Public benefit': 'Z',
+        'Sickday': 'ZV',
+    }
+
+    return obj_mapping[mode]
+
+
+def timetable_slots(timetable):
+    """
+    Flatten a timetable row into 14 slots, even week days first and
+    odd week days second, with weekends left empty.
+    """
+
+    if timetable is None:
+        return [None] * 14
+
+    return [getattr(timetable, name) if name else None for name in SLOT_NAMES]
+
+
+def slot_lengths(slots):
+    """Working minutes of every slot, `None` where there is no work."""
+
+    return [tr.len() if tr and not tr.isempty else None for tr in slots]
+
+
+def validity_bounds(validity):
+    """
+    Convert a date range into half-open `[start, end)` interval of day
+    ordinals, unbounded ends stretching to the first and last date.
+    """
+
+    if validity is None or validity.isempty:
+        return 0, 0
+
+    if validity.lower is None:
+        start = date.min.toordinal()
+    else:
+        start = validity.lower.toordinal() + (0 if validity.lower_inc else 1)
+
+    if validity.upper is None:
+        end = date.max.toordinal() + 1
+    else:
+        end = validity.upper.toordinal() + (1 if validity.upper_inc else 0)
+
+    return start, end
+
+
+class CompiledTimetable:
+    """
+    Timetable row reduced to the bounds of its validity and its 14 slots
+    (see `timetable_slots`) along with their working minutes.
+    """
+
+    __slots__ = ('start', 'end', 'slots', 'lengths')
+
+    def __init__(self, timetable):
+        self.start, self.end = validity_bounds(timetable.validity)
+        self.slots = tuple(timetable_slots(timetable))
+        self.lengths = tuple(slot_lengths(self.slots))
+
+    def covers(self, ordinal):
+        return self.start <= ordinal < self.end
+
+
+class TimetableIndex:
+    """
+    Timetables of a single pv split into disjoint intervals ordered by
+    their start, to look up the one in effect on a given day by a single
+    bisection. Where validities overlap, the timetable starting later wins.
+    """
+
+    __slots__ = ('starts', 'owners')
+
+    def __init__(self, timetables=()):
+        compiled = sorted((CompiledTimetable(tt) for tt in timetables),
+                          key=lambda tt: tt.start)
+        compiled = [tt for tt in compiled if tt.start < tt.end]
+
+        # Timetable in effect from every boundary up to the next one,
+        # `None` for gaps and past the last boundary.
+        self.starts = []
+        self.owners = []
+
+        bounds = sorted({tt.start for tt in compiled} | {tt.end for tt in compiled})
+
+        for bound in bounds:
+            owner = next((tt for tt in reversed(compiled) if tt.covers(bound)), None)
+
+            if self.owners and self.owners[-1] is owner:
+                continue
+
+            self.starts.append(bound)
+            self.owners.append(owner)
+
+    def __bool__(self):
+        return bool(self.owners)
+
+    def at(self, day):
+        """Timetable in effect on given day or `None`."""
+
+        i = bisect_right(self.starts, day.toordinal()) - 1
+        return self.owners[i] if i >= 0 else None
+
+
+class MonthGrid:
+    """
+    Attributes of every day in a month, computed once and shared by all
+    employees. Each attribute is a list with one item per day, so that a
+    whole row of symbols is produced by zipping the columns together.
+    """
+
+    def __init__(self, year, month, today=None):
+        today = today or date.today()
+
+        self.year = year
+        self.month = month
+        self.days = [date(year, month, d + 1)
+                     for d in range(monthrange(year, month)[1])]
+
+        flags = [CZ_CALENDAR.flags(d) for d in self.days]
+
+        self.weekday = [d.weekday() for d in self.days]
+        self.even = [bool(f & EVEN_WEEK) for f in flags]
+        self.holiday = [bool(f & HOLIDAY) for f in flags]
+        self.weekend = [bool(f & WEEKEND) for f in flags]
+        self.future = [d > today for d in self.days]
+
+        self.workday = [not (we or hd)
+                        for we, hd in zip(self.weekend, self.holiday)]
+
+        # Index into timetable slots
+        self.slot = [wd if even else wd + 7
+                     for wd, even in zip(self.weekday, self.even)]
+
+    def __len__(self):
+        return len(self.days)
+
+    def valid(self, validity):
+        """Mask of days covered by given date range."""
+
+        if validity is None:
+            return [False] * len(self.days)
+
+        return [d in validity for d in self.days]
+
+    def timetables(self, index):
+        """Timetable in effect on every day according to given index."""
+
+        return [index.at(d) for d in self.days]
+
+    def slots(self, timetables):
+        """Time range to be worked on every day, `None` where there is none."""
+
+        return [tt.slots[s] if tt else None
+                for s, tt in zip(self.slot, timetables)]
+
+    def lengths(self, timetables):
+        """Working minutes of every day, `None` where there is no work."""
+
+        return [tt.lengths[s] if tt else None
+                for s, tt in zip(self.slot, timetables)]
+
+    def symbols(self, lengths, presence, auto=False):
+        """
+        Compute the row of attendance symbols for a single employee.
+
+        `lengths` holds the working minutes according to the timetable
+        for every day (see `lengths`), `presence` holds
+        the presence row of every day or `None`.
+        """
+
+        return [
+            'S' if weekend else
+            '-' if length is None or future or holiday else
+            self.symbol(length, pres, auto)
+            for weekend, future, holiday, length, pres in zip(
+                self.weekend, self.future, self.holiday, lengths, presence)
+        ]
+
+    @staticmethod
+    def symbol(length, presence, auto):
+        # Employee should have been in workplace but was not present
+        if presence is None:
+            if auto:
+                return '/' if length >= 4 * 60 else '/-'
+            return 'A'
+
+        symbol = eng_to_symbol(presence.presence_mode, presence.food_stamp)
+
+        # Fill in presence according to timetable in automatic mode
+        if symbol in ('/-', 'A') and auto and length >= 4 * 60:
+            return '/'
+
+        return symbol
+
+
+# vim:set sw=4 ts=4 et:
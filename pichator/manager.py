@@ -4,28 +4,44 @@
 __all__ = ['Manager']
 
 from twisted.python import log
-from twisted.internet.task import LoopingCall
-from threading import Thread
-from sqlalchemy import and_, or_, func
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+from sqlalchemy import and_, or_, func, case
 from sqlalchemy.dialects import postgresql
 from sqlalchemy import types as sqltypes
-from sqlalchemy.sql.expression import cast
+from sqlalchemy.sql.expression import cast, literal_column
 from datetime import timedelta, datetime, date, time
+from time import monotonic
 from psycopg2.extras import DateRange, Range, register_range
-from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.exceptions import Forbidden, NotAcceptable, InternalServerError
-from calendar import monthrange, mdays, February, isleap
+from calendar import mdays, February, isleap
 from random import randint
-import holidays
+from pichator.grid import MonthGrid, TimetableIndex
+from pichator.db import released
+from pichator.cache import TTLCache, Versions
+from pichator.scheduler import Scheduler
+from functools import partial
 
 
-CZ_HOLIDAYS = holidays.Czech()
+# Tables whose changes are recorded in the changelog
+TRACKED_TABLES = ('presence', 'pv', 'timetable', 'acls')
 
 
 def monthlen(year, month):
     return mdays[month] + (month == February and isleap(year))
 
 
+def presence_minutes(presence):
+    if presence.worked_minutes is not None:
+        return presence.worked_minutes
+
+    arrival = datetime.combine(date.today(), presence.arrival)
+    departure = datetime.combine(date.today(), presence.departure)
+    return (departure - arrival).total_seconds() / 60
+
+
 class TimeRange(Range):
     def len(self):
         # Returns number of minutes in timerange
@@ -41,64 +57,127 @@ class TIMERANGE(postgresql.ranges.RangeOperators, sqltypes.UserDefinedType):
         return 'timerange'
 
 
-def eng_to_symbol(mode, stamp):
-    obj_mapping = {
-        'Employer difficulties': 'C',
-        'Vacation': 'D',
-        'Vacation 0.5': '0,5D',
-        'Presence': '/' if stamp else '/-',
-        'Absence': 'A',
-        'On call time': 'H',
-        'Sickness': 'N',
-        'Compensatory time off': 'NV',
-        'Family member care': 'O',
-        'Personal trouble': 'P',
-        'Bussiness trip': 'Sc+' if stamp else 'Sc',
-        'Study': 'St',
-        'Training': 'Šk' if stamp else 'Šk-',
-        'Injury and disease from profession': 'Ú',
-        'Unpaid leave': 'V',
-        'Public benefit': 'Z',
-        'Sickday': 'ZV',
-    }
+class Directory(object):
+    """Snapshot of the employee table indexed by username, uid and emp_no."""
+
+    def __init__(self, employees):
+        self.by_username = {emp.username: emp for emp in employees}
+        self.by_uid = {emp.uid: emp for emp in employees}
+        self.by_emp_no = {emp.emp_no: emp for emp in employees if emp.emp_no}
+
+
+class DeptModes(object):
+    """
+    Attendance modes of departments arranged in a prefix tree following
+    the organization structure, where each digit is one more level.
+    """
+
+    # From the most restrictive one
+    ORDER = ('readonly', 'edit', 'auto')
+
+    def __init__(self, rows=()):
+        self.root = [None, {}]
+
+        for dept, mode in rows:
+            self.set(dept, mode)
+
+    def set(self, dept, mode):
+        node = self.root
+
+        for digit in str(dept):
+            node = node[1].setdefault(digit, [None, {}])
+
+        node[0] = mode
+
+    def get(self, dept):
+        """Mode set directly on the department."""
+
+        node = self.root
+
+        for digit in str(dept):
+            node = node[1].get(digit)
+            if node is None:
+                return None
+
+        return node[0]
+
+    def effective(self, dept):
+        """
+        Most restrictive mode set on the department or any of its
+        superiors, `edit` when there is none.
+        """
 
-    return obj_mapping[mode]
+        node = self.root
+        modes = {node[0]}
 
+        for digit in str(dept):
+            node = node[1].get(digit)
+            if node is None:
+                break
+            modes.add(node[0])
 
-def get_dayname(number, even):
-    return ('monday_e', 'tuesday_e', 'wednesday_e', 'thursday_e', 'friday_e', 'saturday_e', 'sunday_e')[number] if even\
-    else ('monday_o', 'tuesday_o', 'wednesday_o', 'thursday_o', 'friday_o', 'saturday_o', 'sunday_o')[number]
+        for mode in self.ORDER:
+            if mode in modes:
+                return mode
+
+        return 'edit'
 
 
 class Manager(object):
-    def __init__(self, db):
+    def __init__(self, db, pool_size=2, cache_ttl=60):
         self.db = db
+        self.cache = TTLCache(cache_ttl)
+        self.versions = Versions()
         register_range('timerange', TimeRange,
                        self.db.engine.raw_connection().cursor(),
                        globally=True)
         self.depts = []
 
-    def get_emp_no(self, username):
+        # Source fetches run concurrently in the pool, while all writes
+        # into our database are serialized through a single writer thread.
+        self.pool_size = pool_size
+        self.pool = ThreadPool(pool_size, pool_size, 'manager')
+        self.writer = ThreadPool(1, 1, 'writer')
+        self.started = False
+
+        # Periodic synchronization from the sources.
+        self.scheduler = Scheduler()
+
+        # Last changelog entry of every table seen by `track_changes`
+        self.changes_seen = {}
+
+    def get_directory(self):
+        """Employee directory, shared by all threads for a short while."""
+
+        return self.cache.get('directory', self.load_directory)
+
+    def load_directory(self):
         emp_t = self.db.employee
-        try:
-            return emp_t.filter(emp_t.username == username).first().emp_no
-        except NoResultFound:
+        employees = self.db.session.query(
+            emp_t.uid, emp_t.username, emp_t.emp_no,
+            emp_t.first_name, emp_t.last_name, emp_t.acl)
+
+        return Directory(employees.all())
+
+    def find_employee(self, username, directory=None):
+        directory = directory or self.get_directory()
+        emp = directory.by_username.get(username)
+
+        if emp is None:
             log.err('User not found. Supplied username: {}'.format(username))
             raise NotAcceptable
 
-    def get_acl(self, username):
-        emp_t = self.db.employee
-        try:
-            return emp_t.filter(emp_t.username == username).one().acl
-        except NoResultFound:
-            log.err(
-                'User not found when looking up acls. Supplied username: {}'.format(username))
-            raise NotAcceptable
+        return emp
 
-    def get_emp_info(self,username):
-        emp_t = self.db.employee
-        emp = emp_t.filter(emp_t.username == username).one()
+    def get_emp_no(self, username, directory=None):
+        return self.find_employee(username, directory).emp_no
+
+    def get_acl(self, username, directory=None):
+        return self.find_employee(username, directory).acl
+
+    def get_emp_info(self, username, directory=None):
         try:
+            emp = self.find_employee(username, directory)
             return({
                 'first_name': emp.first_name,
                 'last_name': emp.last_name,
@@ -108,12 +187,10 @@ class Manager(object):
             log.err(e)
             return([])
 
-    def get_depts(self, username):
-        emp_t = self.db.employee
+    def get_depts(self, username, directory=None):
         pv_t = self.db.pv
         try:
-            emp_uid = emp_t.filter(
-                emp_t.emp_no == self.get_emp_no(username)).one().uid
+            emp_uid = self.find_employee(username, directory).uid
             today = date.today()
             pvs = pv_t.filter(and_(pv_t.uid_employee == emp_uid,
                                    pv_t.validity.contains(today))).all()
@@ -127,18 +204,41 @@ class Manager(object):
         return self.depts
 
     def get_all_employees(self):
+        return self.cache.get('employees', self.load_all_employees)
+
+    def load_all_employees(self):
+        emp_t = self.db.employee
+        pv_t = self.db.pv
+        today = date.today()
+
+        depts = func.array_agg(pv_t.department) \
+            .filter(pv_t.department.isnot(None))
+
+        employees = self.db.session \
+            .query(emp_t.first_name, emp_t.last_name, emp_t.uid,
+                   emp_t.acl, emp_t.username, depts) \
+            .outerjoin(pv_t, and_(pv_t.uid_employee == emp_t.uid,
+                                  pv_t.validity.contains(today))) \
+            .group_by(emp_t.uid) \
+            .order_by(emp_t.last_name)
+
         retval = []
-        for emp in self.db.employee.order_by(self.db.employee.last_name).all():
+        for first_name, last_name, uid, acl, username, emp_depts in employees.all():
             retval.append({
-                'first_name': emp.first_name,
-                'last_name': emp.last_name,
-                'uid': emp.uid,
-                'acl': emp.acl,
-                'depts': self.get_depts(emp.username),
-                'username': emp.username
+                'first_name': first_name,
+                'last_name': last_name,
+                'uid': uid,
+                'acl': acl,
+                'depts': emp_depts or [],
+                'username': username
             })
         return retval
 
+    def invalidate_employees(self):
+        self.cache.invalidate('directory')
+        self.cache.invalidate('employees')
+        self.versions.bump('employee')
+
     def month_range(self, year, month):
         days = monthlen(year, month)
         return DateRange(date(year, month, 1), date(year, month, days), '[]')
@@ -147,20 +247,23 @@ class Manager(object):
         for n in range(int((dr.upper - dr.lower).days)):
             yield dr.lower + timedelta(n)
 
-    def get_employees(self, dept, month, year):
-        retval = []
+    def dept_pvs_query(self, dept, month, year):
+        """Pvs of a department and its subordinates in a month, with employees."""
 
         emp_t = self.db.employee
         pv_t = self.db.pv
 
-        employees_with_pvs = self.db.session \
-            .query(emp_t, pv_t) \
-            .order_by(emp_t.last_name) \
-            .join(pv_t) \
+        return self.db.session \
+            .query(pv_t, emp_t) \
+            .join(emp_t) \
             .filter(pv_t.validity.overlaps(self.month_range(year, month))) \
-            .filter(cast(pv_t.department, sqltypes.String).startswith(dept))
+            .filter(cast(pv_t.department, sqltypes.String).startswith(dept)) \
+            .order_by(emp_t.last_name)
 
-        for employee, pv in employees_with_pvs.all():
+    def get_employees(self, dept, month, year):
+        retval = []
+
+        for pv, employee in self.dept_pvs_query(dept, month, year).all():
             retval.append({
                 'first_name': employee.first_name,
                 'last_name': employee.last_name,
@@ -173,18 +276,57 @@ class Manager(object):
         return retval
 
     def threaded_init(self, year, month, source):
-        th_init = Thread(target=self.init_presence, args=(year, month, source))
-        th_init.start()
+        return self.write(self.init_presence, year, month, source)
 
-    def threaded_update_presence(self, source, source_name):
+    def threaded_update_presence(self, source, source_name, timeline=False):
         log.msg('Syncing presence from {}'.format(source_name))
-        th_up_pres = Thread(target=self.update_presence, args=(source,))
-        th_up_pres.start()
+        date = datetime.now().date()
+
+        if timeline:
+            d = deferToThreadPool(reactor, self.pool, released(source.get_timelines), date)
+            d.addCallback(lambda timelines: self.write(self.merge_timelines, timelines))
+            return d
+
+        d = deferToThreadPool(reactor, self.pool, released(source.get_passes), date)
+        d.addCallback(lambda passes: self.write(self.merge_passes, passes))
+        return d
+
+    def threaded_poll_passes(self, source, source_name):
+        d = deferToThreadPool(reactor, self.pool, released(source.get_new_passes))
+        d.addCallback(lambda passes: passes and self.write(self.merge_passes, passes))
+        return d
 
     def threaded_update_pvs(self, elanor):
         log.msg('Syncing pvs from elanor')
-        th_up_pv = Thread(target=self.update_pvs, args=(elanor, ))
-        th_up_pv.start()
+
+        # One batch for every thread, split by hash of the contract number
+        batches = [deferToThreadPool(reactor, self.pool, released(elanor.get_contracts),
+                                     part, self.pool_size)
+                   for part in range(self.pool_size)]
+
+        d = DeferredList(batches, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallback(lambda results: [contract
+                                       for _, batch in results
+                                       for contract in batch])
+        d.addCallback(lambda contracts: self.write(self.store_contracts, elanor, contracts))
+        return d
+
+    def start(self):
+        """Start the thread pools, stopping them when the reactor does."""
+
+        if self.started:
+            return
+
+        for pool in (self.pool, self.writer):
+            pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+
+        self.started = True
+
+    def write(self, fn, *args, **kwargs):
+        """Run `fn` in the writer thread, returns a Deferred."""
+
+        return deferToThreadPool(reactor, self.writer, released(fn), *args, **kwargs)
 
     def get_timetables(self, emp_uid):
         payload = {'data': []}
@@ -228,17 +370,26 @@ class Manager(object):
 
         return payload
 
+    def get_dept_modes(self):
+        return self.cache.get('dept_modes', self.load_dept_modes)
+
+    def load_dept_modes(self):
+        acls_t = self.db.acls
+        return DeptModes(self.db.session.query(acls_t.dept, acls_t.acl).all())
+
     def get_dept_mode(self, dept):
+        return self.get_dept_modes().get(dept)
+
+    def get_effective_dept_mode(self, dept):
+        return self.get_dept_modes().effective(dept)
+
+    def dept_mode_query(self, dept):
         acls_t = self.db.acls
-        mode_row = acls_t.filter(acls_t.dept == str(dept)).first()
-        if not mode_row:
-            return
-        else:
-            return mode_row.acl
+        return acls_t.filter(acls_t.dept == dept)
 
     def set_dept_mode(self, dept, mode):
         acls_t = self.db.acls
-        prev_mode_row = acls_t.filter(acls_t.dept == dept)
+        prev_mode_row = self.dept_mode_query(dept)
         if prev_mode_row.first():
             acl = prev_mode_row.first().acl
             if mode == acl:
@@ -249,6 +400,20 @@ class Manager(object):
             acls_t.insert(dept=dept, acl=mode)
 
         self.db.commit()
+        self.cache.invalidate('dept_modes')
+        self.versions.bump('acls')
+
+    def current_timetable_query(self, pvid, day):
+        """Pv with the timetable in effect on given day."""
+
+        pv_t = self.db.pv
+        timetable_t = self.db.timetable
+
+        return self.db.session.query(pv_t, timetable_t) \
+            .join(pv_t) \
+            .filter(pv_t.pvid == pvid) \
+            .filter(pv_t.validity.contains(day)) \
+            .filter(timetable_t.validity.contains(day))
 
     def set_timetables(self, data):
         # returns True if commit succeeds, False otherwise
@@ -360,9 +525,7 @@ class Manager(object):
             # Filled in hours are not matching occupancy
             return False
 
-        query = self.db.session().query(pv_t, timetable_t).join(pv_t)
-        pv_with_timetable = query.filter(and_(pv_t.pvid == pvid_v), pv_t.validity.contains(
-            start_date), timetable_t.validity.contains(start_date)).first()
+        pv_with_timetable = self.current_timetable_query(pvid_v, start_date).first()
 
         if pv_with_timetable:
             pv, timetable = pv_with_timetable
@@ -390,23 +553,30 @@ class Manager(object):
                                    thursday_o=thursday_v_o, friday_o=friday_v_o,
                                    validity=validity_v, uid_pv=valid_pv_uid)
             self.db.commit()
-            return True
         except Exception as e:
             log.err(e)
             self.db.rollback()
             raise InternalServerError
 
-    def get_pvs(self, emp_uid, month, year):
-        retval = []
+        self.versions.bump('timetable')
 
+        # Backdated timetable changes symbols of already closed months
+        self.refresh_summaries((pv.uid_employee, day)
+                               for day in self.month_starts(start_date, date.today()))
+        return True
+
+    def pvs_query(self, emp_uid, month, year):
         pv_t = self.db.pv
 
-        pvs = self.db.session \
+        return self.db.session \
             .query(pv_t) \
             .filter(pv_t.uid_employee == emp_uid) \
             .filter(pv_t.validity.overlaps(self.month_range(year, month)))
 
-        for pv in pvs.all():
+    def get_pvs(self, emp_uid, month, year):
+        retval = []
+
+        for pv in self.pvs_query(emp_uid, month, year).all():
             retval.append({
                 'pvid': pv.pvid,
                 'department': pv.department
@@ -418,7 +588,6 @@ class Manager(object):
         result = {}
         days = monthlen(year, month)
 
-        time_t = self.db.timetable
         pres_t = self.db.presence
         pv_t = self.db.pv
 
@@ -426,25 +595,15 @@ class Manager(object):
         today = date.today()
 
         current_pv = pv_t.filter(pv_t.pvid == pvid) \
-            .filter(pv_t.validity.overlaps(month_range))
-        dept = str(current_pv.one().department)
+            .filter(pv_t.validity.overlaps(month_range)) \
+            .one()
+        dept = str(current_pv.department)
 
-        if current_pv.one().uid_employee != uid and not self.is_supervisor(uid, current_pv.one().uid_employee) and not admin:
+        if current_pv.uid_employee != uid and not self.is_supervisor(uid, current_pv.uid_employee) and not admin:
             raise Forbidden
 
-        # create list of acls in organization structure
-        acls = [self.get_dept_mode(dept[:i]) for i in range(
-            len(dept) + 1) if self.get_dept_mode(dept[:i])]
-
         # set acl to most restrictive setting from organization structure with default value edit
-        dept_acl = 'edit'
-
-        if 'readonly' in acls:
-            dept_acl = 'readonly'
-        elif 'edit' in acls:
-            dept_acl = 'edit'
-        elif 'auto' in acls:
-            dept_acl = 'auto'
+        dept_acl = self.get_effective_dept_mode(dept)
 
         # generate empty month with no presence
         for day in range(1, days + 1):
@@ -460,14 +619,7 @@ class Manager(object):
         presence = pres_t \
             .filter(pres_t.date >= month_range.lower) \
             .filter(pres_t.date <= month_range.upper) \
-            .filter(pres_t.uid_employee == current_pv.one().uid_employee)
-
-        timetables = time_t \
-            .join(pv_t) \
-            .filter(pv_t.pvid == pvid) \
-            .filter(time_t.validity.overlaps(month_range))
-
-        all_timetables = timetables.all()
+            .filter(pres_t.uid_employee == current_pv.uid_employee)
 
         # fill in actual presence
         len_sum = timedelta(0)
@@ -485,72 +637,98 @@ class Manager(object):
             }}
 
         # add timetable info
-        for _, day in result.items():
+        grid = MonthGrid(year, month, today)
+
+        # Timetables stay with former rows of the pv after department changes
+        pv_uids = [uid for uid, in self.db.session.query(pv_t.uid).filter(pv_t.pvid == pvid)]
+        index = TimetableIndex(self.timetables_query(pv_uids, year, month).all())
+        slots = grid.slots(grid.timetables(index))
+
+        for i, day in enumerate(result.values()):
             day['len_sum'] = len_sum
-            for timetable in all_timetables:
-                weekday = day['date'].weekday()
-                even_week = day['date'].isocalendar()[1] % 2 == 0
-                
-                if day['date'] in timetable.validity and\
-                weekday < 5 and\
-                day['date'] not in CZ_HOLIDAYS and\
-                getattr(timetable, get_dayname(weekday, even_week)):
-                    day['timetable'] = getattr(timetable, get_dayname(weekday, even_week))
-                    if dept_acl == 'auto':
-                        # pretend employee was present according to timetable
-                        if day['mode'] in ['Absence', 'Presence', None]:
-                            day['mode'] = 'Presence'
-                            # random offset to make arrivals more believable
-                            offset = randint(0, 22)
-                            arrival = getattr(
-                                timetable, get_dayname(weekday, even_week)).lower
-                            offset_arrival = datetime.combine(
-                                date(1, 1, 1), arrival) - timedelta(minutes=offset)
-                            day['arrival'] = offset_arrival.time()
-
-                            # people are less likely to stay much longer than needed
-                            offset = randint(0, 7)
-                            departure = getattr(
-                                timetable, get_dayname(weekday, even_week)).upper
-                            offset_departure = datetime.combine(
-                                date(1, 1, 1), departure) + timedelta(minutes=offset)
-                            day['departure'] = offset_departure.time()
-                    else:
-                        day['mode'] = day['mode'] or (
-                            'Absence' if day['timetable'] and day['date'] <= today else None)
-                    break
+
+            if not grid.workday[i] or not slots[i]:
+                continue
+
+            day['timetable'] = slots[i]
+            if dept_acl == 'auto':
+                # pretend employee was present according to timetable
+                if day['mode'] in ['Absence', 'Presence', None]:
+                    day['mode'] = 'Presence'
+                    # random offset to make arrivals more believable
+                    offset = randint(0, 22)
+                    offset_arrival = datetime.combine(
+                        date(1, 1, 1), slots[i].lower) - timedelta(minutes=offset)
+                    day['arrival'] = offset_arrival.time()
+
+                    # people are less likely to stay much longer than needed
+                    offset = randint(0, 7)
+                    offset_departure = datetime.combine(
+                        date(1, 1, 1), slots[i].upper) + timedelta(minutes=offset)
+                    day['departure'] = offset_departure.time()
+            else:
+                day['mode'] = day['mode'] or (
+                    'Absence' if not grid.future[i] else None)
         return result
 
+    def timetables_query(self, pv_uids, year, month):
+        time_t = self.db.timetable
+
+        return time_t \
+            .filter(time_t.uid_pv.in_(pv_uids)) \
+            .filter(time_t.validity.overlaps(self.month_range(year, month)))
+
+    def get_timetable_indexes(self, pv_uids, year, month):
+        """
+        Compile timetables of given pvs in effect during a month into
+        an index per pv, keyed by pv uid.
+        """
+
+        by_pv = {uid: [] for uid in pv_uids}
+
+        for timetable in self.timetables_query(pv_uids, year, month).all():
+            by_pv[timetable.uid_pv].append(timetable)
+
+        return {uid: TimetableIndex(tts) for uid, tts in by_pv.items()}
+
     def set_acls(self, datadict):
         emp_t = self.db.employee
         for emp_uid in datadict.keys():
             emp_t.filter(emp_t.uid == emp_uid).update(
                 {'acl': datadict[emp_uid]})
         self.db.commit()
+        self.invalidate_employees()
 
-    def pvid_to_username(self, pvid):
+    def pvid_to_username(self, pvid, directory=None):
         emp_no = pvid.split('.')[0]
-        emp_t = self.db.employee
-        try:
-            return emp_t.filter(emp_t.emp_no == emp_no).one().username
-        except Exception as e:
-            log.err(e)
+        directory = directory or self.get_directory()
+        emp = directory.by_emp_no.get(emp_no)
+
+        if emp is None:
             log.err('User belonging to pvid {} not found.'.format(pvid))
             raise NotAcceptable
-        return ''
 
-    def is_supervisor(self, user_uid, employee_uid):
-        emp_t = self.db.employee
+        return emp.username
 
-        acl = emp_t.get(user_uid).acl
-        user = emp_t.filter(emp_t.uid == employee_uid).one().username
+    def is_supervisor(self, user_uid, employee_uid, directory=None):
+        directory = directory or self.get_directory()
 
-        for dept in self.get_depts(user):
+        acl = directory.by_uid[user_uid].acl
+        user = directory.by_uid[employee_uid].username
+
+        for dept in self.get_depts(user, directory):
             if str(dept).startswith(acl):
                 return True
 
         return False
 
+    def attendance_query(self, employee_uid, date):
+        pres_t = self.db.presence
+
+        return pres_t \
+            .filter(pres_t.uid_employee == employee_uid) \
+            .filter(pres_t.date == date)
+
     def set_attendance(self, date, employee_uid, start, end, mode):
         pres_t = self.db.presence
 
@@ -561,16 +739,17 @@ class Manager(object):
         # If attendance is longer than 4 hours employee can have food stamp
         food_stamp = duration >= 4
 
-        presence = pres_t \
-            .filter(pres_t.uid_employee == employee_uid) \
-            .filter(pres_t.date == date)
+        presence = self.attendance_query(employee_uid, date)
 
         if presence.first():
+            # Presence entered by hand replaces the one reconstructed from passes
             presence.update({
                 'arrival': start,
                 'departure': end,
                 'food_stamp': food_stamp,
                 'presence_mode': mode,
+                'worked_minutes': None,
+                'intervals': None,
             })
         else:
             pres_t.insert(**{
@@ -584,6 +763,11 @@ class Manager(object):
 
         self.db.commit()
 
+        day = datetime.strptime(date, '%Y-%m-%d').date()
+        self.cache.invalidate(('present', day))
+        self.versions.bump(('presence', day.year, day.month))
+        self.refresh_summaries([(employee_uid, day)])
+
     def get_dept(self, pvid, date):
         pv_t = self.db.pv
         pv = pv_t.filter(
@@ -596,94 +780,42 @@ class Manager(object):
 
     def get_department(self, dept, month, year):
         retval = {'data': []}
-        gen_mode = self.get_dept_mode(dept)
-        found = False
+        auto = self.get_dept_mode(dept) == 'auto'
 
-        emp_t = self.db.employee
-        pv_t = self.db.pv
-        pres_t = self.db.presence
-        timetable_t = self.db.timetable
+        month_period = self.month_range(year, month)
+        pv_with_emp = self.dept_pvs_query(dept, month, year).all()
 
-        per_range = monthrange(year, month)
-        query = self.db.session.query(pv_t, emp_t, timetable_t)\
-            .join(emp_t)\
-            .outerjoin(timetable_t)
+        # Closed months are read from stored summaries, the rest is computed
+        closed = self.is_closed(year, month)
+        summaries = {}
 
-        month_period = DateRange(date(year, month, 1), date(
-            year, month, per_range[1]), '[]')
+        if closed:
+            summaries = self.load_summaries([pv.uid for pv, _ in pv_with_emp], year, month)
 
-        pv_with_emp = query \
-            .filter(pv_t.validity.overlaps(month_period))\
-            .filter(timetable_t.validity.overlaps(month_period))\
-            .filter(cast(pv_t.department, sqltypes.String).startswith(dept)).order_by(emp_t.last_name).all()
+        missing = [pv.uid for pv, _ in pv_with_emp if pv.uid not in summaries]
 
-        if not pv_with_emp:
-            log.msg(
-                'No valid employees with timetable for period {} - {}'.format(month_period.lower, month_period.upper))
-            return retval
+        if missing:
+            computed = self.summarize(missing, year, month)
+            if closed:
+                self.store_summaries(year, month, computed)
+            summaries.update(computed)
+
+        for pv, employee in pv_with_emp:
+            symbols = summaries[pv.uid]['auto_symbols' if auto else 'symbols']
+
+            # Pv without timetable in this month
+            if symbols is None:
+                continue
 
-        for pv, employee, timetable in pv_with_emp:
             # Select pvs in the department itself or subordinate departments
             retval_dict = {
                 'name': '{} {}'.format(employee.first_name, employee.last_name),
                 'pvid': pv.pvid
             }
-            for day in range(per_range[1]):
-                curr_date = date(year, month, day + 1)
-
-                if timetable and curr_date in timetable.validity:
-                    timetable_list = [
-                        timetable.monday_e,
-                        timetable.tuesday_e,
-                        timetable.wednesday_e,
-                        timetable.thursday_e,
-                        timetable.friday_e,
-                        None,
-                        None,
-                        timetable.monday_o,
-                        timetable.tuesday_o,
-                        timetable.wednesday_o,
-                        timetable.thursday_o,
-                        timetable.friday_o,
-                        None,
-                        None,
-                    ]
-                else:
-                    timetable_list = [None] * 14
-                even_week = curr_date.isocalendar()[1]%2 == 0
-                current_timetable = timetable_list[curr_date.weekday()] if even_week else timetable_list[curr_date.weekday() + 7]
-                presence = pres_t.filter(
-                    and_(pres_t.uid_employee ==
-                         employee.uid, pres_t.date == curr_date)
-                ).first()
-                # Weekend
-                if curr_date.isoweekday() in [6, 7]:
-                    symbol = 'S'
-                # This timetable is not valid on this day,
-                # it is non working day for the employee or the day is in future
-                elif current_timetable == None or current_timetable.isempty or curr_date > date.today() or curr_date in CZ_HOLIDAYS:
-                    symbol = '-'
-
-                # Employee has valid timetable for the day and should have been in workplace but was not present
-                elif not presence:
-                    # Automatically generated presence
-                    if gen_mode == 'auto':
-                        if current_timetable.len() >= 4*60:
-                            symbol = '/'
-                        else:
-                            symbol = '/-'
-                    else:
-                        symbol = 'A'
-
-                # Employee was present or was on vacation, business trip etc.
-                else:
-                    symbol = eng_to_symbol(
-                        presence.presence_mode, presence.food_stamp
-                    )
-                    # If employee was present for shorter time and presence is automatically generated fill in presence acording timetable
-                    if symbol in ['/-', 'A'] and gen_mode == 'auto' and current_timetable.len() >= 4*60:
-                        symbol = '/'
-                retval_dict[str(day+1)] = symbol
+
+            for day, symbol in enumerate(symbols, 1):
+                retval_dict[str(day)] = symbol
+
             found = False
             # If there exist record for this pv in this month with different timetable - merge them
             for record in retval['data']:
@@ -695,119 +827,564 @@ class Manager(object):
             if not found:
                retval['data'].append(retval_dict)
 
+        if not retval['data']:
+            log.msg(
+                'No valid employees with timetable for period {} - {}'.format(month_period.lower, month_period.upper))
+
         return retval
 
+    def is_closed(self, year, month):
+        """Month has ended, its attendance is not going to change on its own."""
+
+        return date(year, month, monthlen(year, month)) < date.today()
+
+    def month_starts(self, since, until):
+        day = date(since.year, since.month, 1)
+
+        while day <= until:
+            yield day
+            day = date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+    def summarize(self, pv_uids, year, month):
+        """
+        Compute attendance summaries of given pvs for a month, keyed by
+        pv uid. Symbols of pvs without a timetable in the month are `None`.
+        """
+
+        pv_t = self.db.pv
+        pres_t = self.db.presence
+
+        month_period = self.month_range(year, month)
+
+        pvs = pv_t.filter(pv_t.uid.in_(pv_uids)).all()
+
+        if not pvs:
+            return {}
+
+        indexes = self.get_timetable_indexes([pv.uid for pv in pvs], year, month)
+
+        # Fetch presence of all the employees for the month at once
+        uids = {pv.uid_employee for pv in pvs}
+        presences = pres_t \
+            .filter(pres_t.uid_employee.in_(uids)) \
+            .filter(pres_t.date >= month_period.lower) \
+            .filter(pres_t.date <= month_period.upper)
+
+        presence_map = {(p.uid_employee, p.date): p for p in presences.all()}
+        grid = MonthGrid(year, month)
+        summaries = {}
+
+        for pv in pvs:
+            presence = [presence_map.get((pv.uid_employee, d)) for d in grid.days]
+            worked = [p for p, valid in zip(presence, grid.valid(pv.validity))
+                      if p is not None and valid]
+
+            summary = summaries[pv.uid] = {
+                'symbols': None,
+                'auto_symbols': None,
+                'worked_minutes': int(sum(presence_minutes(p) for p in worked)),
+                'food_stamps': sum(1 for p in worked if p.food_stamp),
+            }
+
+            index = indexes[pv.uid]
+            if not index:
+                continue
+
+            lengths = grid.lengths(grid.timetables(index))
+            summary['symbols'] = grid.symbols(lengths, presence)
+            summary['auto_symbols'] = grid.symbols(lengths, presence, auto=True)
+
+        return summaries
+
+    def load_summaries(self, pv_uids, year, month):
+        summary_t = self.db.month_summary
+
+        rows = summary_t \
+            .filter(summary_t.uid_pv.in_(pv_uids)) \
+            .filter(summary_t.month == date(year, month, 1))
+
+        return {row.uid_pv: {
+            'symbols': row.symbols,
+            'auto_symbols': row.auto_symbols,
+            'worked_minutes': row.worked_minutes,
+            'food_stamps': row.food_stamps,
+        } for row in rows.all()}
+
+    def store_summaries(self, year, month, summaries):
+        """Upsert summaries of pvs for a month, as computed by `summarize`."""
+
+        if not summaries:
+            return
+
+        summary_t = self.db.month_summary._table
+        month_start = date(year, month, 1)
+
+        stmt = postgresql.insert(summary_t).values([
+            {'uid_pv': uid_pv, 'month': month_start, **summary}
+            for uid_pv, summary in summaries.items()
+        ])
+
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[summary_t.c.uid_pv, summary_t.c.month],
+            set_={name: stmt.excluded[name] for name in
+                  ('symbols', 'auto_symbols', 'worked_minutes', 'food_stamps')})
+
+        try:
+            self.db.session.execute(stmt)
+            self.db.commit()
+        except Exception as e:
+            log.err(e)
+            self.db.rollback()
+            raise
+
+    def refresh_summaries(self, touched):
+        """
+        Recompute stored summaries of closed months for all pvs of the
+        employees in `(uid_employee, day)` pairs touched by a change.
+        """
+
+        pv_t = self.db.pv
+        months = {}
+
+        for uid, day in touched:
+            if self.is_closed(day.year, day.month):
+                months.setdefault((day.year, day.month), set()).add(uid)
+
+        for (year, month), uids in sorted(months.items()):
+            pvs = self.db.session.query(pv_t.uid) \
+                .filter(pv_t.uid_employee.in_(uids)) \
+                .filter(pv_t.validity.overlaps(self.month_range(year, month)))
+
+            pv_uids = [uid for uid, in pvs.all()]
+            if pv_uids:
+                self.store_summaries(year, month, self.summarize(pv_uids, year, month))
+
+    def drop_summaries(self, emp_uids):
+        """Forget stored summaries of employees, they are recomputed on demand."""
+
+        pv_t = self.db.pv
+        summary_t = self.db.month_summary
+
+        pvs = self.db.session.query(pv_t.uid).filter(pv_t.uid_employee.in_(emp_uids))
+        summary_t.filter(summary_t.uid_pv.in_(pvs.subquery())) \
+            .delete(synchronize_session=False)
+
     def init_presence(self, year, month, source):
-        days = monthlen(year, month)
+        first = date(year, month, 1)
+        return self.backfill(source, first, date(year, month, monthlen(year, month)))
+
+    def backfill(self, source, date_from, date_to, chunk_days=7, timeline=False):
+        """
+        Load presence of a date range from the badge source in chunks of
+        days, each fetched with one query and merged with one upsert.
+
+        The last finished day is checkpointed in `helper_variables`, so
+        that an interrupted backfill of the same range resumes after it.
+        The checkpoint is dropped once the range is done, so that running
+        it again loads it anew. Summaries of closed months are refreshed
+        once at the end.
+        """
+
+        if chunk_days < 1:
+            raise ValueError('Backfill needs chunks of at least one day')
+
+        key = 'backfill {} {}'.format(date_from.isoformat(), date_to.isoformat())
+        checkpoint = self.get_helper(key)
+        day = date_from
+
+        if checkpoint:
+            day = datetime.strptime(checkpoint, '%Y-%m-%d').date() + timedelta(days=1)
+            log.msg('Resuming backfill of {} - {} from {}'.format(date_from, date_to, day))
+
+        started = monotonic()
+        days = rows = 0
+
+        while day <= date_to:
+            chunk_end = min(day + timedelta(days=chunk_days - 1), date_to)
+
+            if timeline:
+                rows += self.merge_timelines(source.get_timelines(day, chunk_end), refresh=False)
+            else:
+                rows += self.merge_passes(source.get_passes(day, chunk_end), refresh=False)
+
+            self.set_helper(key, chunk_end.isoformat())
+
+            days += (chunk_end - day).days + 1
+            elapsed = monotonic() - started
+            log.msg('Backfilled {} - {}: {} rows in {:.1f}s, {:.1f} days/s, {:.0f} rows/s'.format(
+                day, chunk_end, rows, elapsed, days / elapsed, rows / elapsed))
+
+            day = chunk_end + timedelta(days=1)
+
+        employees = self.get_directory().by_uid
+        self.refresh_summaries((uid, month) for uid in employees
+                               for month in self.month_starts(date_from, date_to))
+
+        self.drop_helper(key)
+
+        log.msg('Backfill of {} - {} finished: {} days, {} rows in {:.1f}s'.format(
+            date_from, date_to, days, rows, monotonic() - started))
+
+        return rows
+
+    def get_helper(self, key):
+        helper_t = self.db.helper_variables
+        helper = helper_t.filter(helper_t.key == key).first()
+        return helper.value if helper else None
 
-        for day in days:
-            date = date(year, month, day + 1)
-            self.update_presence(source, date)
+    def set_helper(self, key, value):
+        helper_t = self.db.helper_variables
+        helper = helper_t.filter(helper_t.key == key)
+
+        if helper.first():
+            helper.update({'value': value})
+        else:
+            helper_t.insert(key=key, value=value)
+
+        self.db.commit()
+
+    def drop_helper(self, key):
+        helper_t = self.db.helper_variables
+        helper_t.filter(helper_t.key == key).delete(synchronize_session=False)
+        self.db.commit()
 
     def update_presence(self, source, date=None):
-        pres_t = self.db.presence
         emp_t = self.db.employee
 
         if not date:
             date = datetime.now().date()
 
-        for employee in emp_t.all():
-            log.msg('Checking presence for user {} for {}'.format(
-                employee.username, date.strftime('%Y-%m-%d')))
-            arriv = source.get_arrival(date, employee.uid)
-            depart = source.get_departure(date, employee.uid)
+        log.msg('Checking presence for {}'.format(date.strftime('%Y-%m-%d')))
+        return self.merge_passes(source.get_passes(date))
+
+    def merge_passes(self, passes, refresh=True):
+        """Merge `{(uid, date): (arrival, departure)}` badge data."""
+
+        employees = self.get_directory().by_uid
+        rows = []
 
-            if not arriv:
+        for (uid, day), (arriv, depart) in passes.items():
+            if uid not in employees:
                 continue
 
             length = (depart - arriv).seconds / 3600
-            presence_mode = 'Presence'
-            food_stamp = length >= 4
-
-            current = pres_t.filter(pres_t.uid_employee == employee.uid) \
-                            .filter(pres_t.date == date) \
-                            .first()
-
-            if not current:
-                pres_t.insert(**{
-                    'date': date,
-                    'arrival': arriv.time(),
-                    'departure': depart.time(),
-                    'presence_mode': presence_mode,
-                    'uid_employee': employee.uid,
-                    'food_stamp': food_stamp
-                })
-            else:
-                current.arrival = func.least(arriv.time(), pres_t.arrival)
-                current.departure = func.greatest(
-                    depart.time(), pres_t.departure)
-                current.food_stamp = food_stamp
 
-        self.db.commit()
-        
+            rows.append({
+                'date': day,
+                'arrival': arriv.time(),
+                'departure': depart.time(),
+                'presence_mode': 'Presence',
+                'uid_employee': uid,
+                'food_stamp': length >= 4,
+                'worked_minutes': None,
+                'intervals': None,
+            })
+
+        return self.merge_presence(rows, refresh)
+
+    def merge_timelines(self, timelines, refresh=True):
+        """
+        Merge `{(uid, date): (arrival, departure, worked_minutes, intervals)}`
+        presence reconstructed from all badge passes.
+        """
+
+        employees = self.get_directory().by_uid
+        rows = []
+
+        for (uid, day), (arriv, depart, worked, intervals) in timelines.items():
+            if uid not in employees:
+                continue
+
+            rows.append({
+                'date': day,
+                'arrival': arriv.time(),
+                'departure': depart.time(),
+                'presence_mode': 'Presence',
+                'uid_employee': uid,
+                'food_stamp': worked >= 4 * 60,
+                'worked_minutes': worked,
+                'intervals': intervals,
+            })
+
+        return self.merge_presence(rows, refresh)
+
+    def merge_presence(self, rows, refresh=True):
+        """
+        Merge badge presence into the `presence` table with a single
+        upsert, widening already recorded arrival and departure.
+
+        Worked minutes reconstructed from passes are kept unless the rows
+        bring new ones or widen the span between arrival and departure, and
+        take precedence over that span when deciding about the food stamp. Summaries of the
+        touched closed months are refreshed unless `refresh` is false.
+        """
+
+        if not rows:
+            return 0
+
+        pres_t = self.db.presence._table
+
+        stmt = postgresql.insert(pres_t).values(rows)
+        arrival = func.least(pres_t.c.arrival, stmt.excluded.arrival)
+        departure = func.greatest(pres_t.c.departure, stmt.excluded.departure)
+
+        # Recorded worked minutes and intervals no longer describe the day
+        # once its span widens, they are dropped until rows bring new ones.
+        same_span = and_(arrival == pres_t.c.arrival, departure == pres_t.c.departure)
+        worked = case([(stmt.excluded.worked_minutes.isnot(None), stmt.excluded.worked_minutes),
+                       (same_span, pres_t.c.worked_minutes)])
+        intervals = case([(stmt.excluded.worked_minutes.isnot(None), stmt.excluded.intervals),
+                          (same_span, pres_t.c.intervals)])
+
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[pres_t.c.uid_employee, pres_t.c.date],
+            set_={
+                'arrival': arrival,
+                'departure': departure,
+                'worked_minutes': worked,
+                'intervals': intervals,
+                'food_stamp': func.coalesce(worked * literal_column("interval '1 minute'"),
+                                            departure - arrival) >= literal_column("interval '4 hours'"),
+            })
+
+        try:
+            self.db.session.execute(stmt)
+            self.db.commit()
+        except Exception as e:
+            log.err(e)
+            self.db.rollback()
+            raise
+
+        for day in {row['date'] for row in rows}:
+            self.cache.invalidate(('present', day))
+
+        self.versions.bump(*{('presence', row['date'].year, row['date'].month) for row in rows})
+
+        if refresh:
+            self.refresh_summaries((row['uid_employee'], row['date']) for row in rows)
+
+        return len(rows)
+
     def get_present(self, date):
-        retval = []
-        pres_t = self.db.presence
-        for dept in self.get_all_depts():
-            item = {'dept_no': dept, 'emp': []}
-            emp_set = set()
-            for employee in self.get_employees(dept, date.month, date.year):
-                presence = pres_t.filter(pres_t.uid_employee == employee['uid']).filter(pres_t.date == date).first()
-                if presence and presence.presence_mode == 'Presence' and str(employee['dept']) == dept:
-                    emp_set.add(employee['first_name'] + ' ' + employee['last_name'])
-            item['emp'] = list(emp_set)
-            retval.append(item)
-        return retval
-                
-                
-            
+        return self.cache.get(('present', date), self.load_present, date)
 
-    def sync(self, source, source_name, elanor):
-        self.source_loop = LoopingCall(
-            self.threaded_update_presence, source=source, source_name=source_name)
+    def present_query(self, date):
+        """Departments and names of employees present on given day."""
+
+        emp_t = self.db.employee
+        pv_t = self.db.pv
+        pres_t = self.db.presence
 
-        self.elanor_loop = LoopingCall(
-            self.update_pvs, elanor=elanor)
+        return self.db.session \
+            .query(pv_t.department, emp_t.first_name, emp_t.last_name) \
+            .join(emp_t, emp_t.uid == pv_t.uid_employee) \
+            .join(pres_t, and_(pres_t.uid_employee == emp_t.uid,
+                               pres_t.date == date)) \
+            .filter(pv_t.validity.overlaps(self.month_range(date.year, date.month))) \
+            .filter(pres_t.presence_mode == 'Presence') \
+            .distinct()
+
+    def load_present(self, date):
+        by_dept = {}
+        for dept, first_name, last_name in self.present_query(date).all():
+            by_dept.setdefault(str(dept), []).append(first_name + ' ' + last_name)
+
+        return [{'dept_no': dept, 'emp': by_dept.get(dept, [])}
+                for dept in self.get_all_depts()]
+
+    def sync(self, source, source_name, elanor, presence_interval=3600,
+             passes_interval=60, pvs_interval=3600, retry=60, timeline=False,
+             changes_interval=60, changelog_retention=30):
+        self.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.scheduler.stop)
+
+        # New passes are polled often, while the whole day is reconciled
+        # less frequently to pick up passes that were recorded late.
+        self.scheduler.add('passes', partial(self.threaded_poll_passes, source, source_name),
+                           passes_interval, retry=retry)
+        self.scheduler.add('presence', partial(self.threaded_update_presence, source, source_name,
+                                               timeline),
+                           presence_interval, retry=retry)
+        self.scheduler.add('pvs', partial(self.threaded_update_pvs, elanor),
+                           pvs_interval, retry=retry)
+
+        self.scheduler.add('changes', partial(deferToThreadPool, reactor, self.pool,
+                                              released(self.track_changes)),
+                           changes_interval, retry=retry)
+        self.scheduler.add('changelog', partial(self.write, self.prune_changes, changelog_retention),
+                           24 * 3600, retry=retry)
+
+    def changed_since(self, table, last_id=None):
+        """
+        Changes of rows of a tracked table logged after the entry `last_id`
+        as `(changes, last_id)`, where changes are `(row_id, op, row_date)`
+        in the order they were made, `op` being one of `I`, `U` or `D` and
+        `row_date` the day of presence rows. The returned `last_id` is to
+        be passed to the next call. Without `last_id` no changes are
+        returned, only the id to start following the log from.
+
+        Entry ids are taken before the transactions commit, so entries of
+        a transaction committing after a later entry has been read are
+        still missed. Times are even less reliable, being taken at the
+        start of the transactions.
+        """
+
+        if table not in TRACKED_TABLES:
+            raise ValueError('Changes of table {} are not tracked'.format(table))
+
+        log_t = self.db.changelog
+
+        if last_id is None:
+            last_id = self.db.session \
+                .query(func.coalesce(func.max(log_t.id), 0)) \
+                .scalar()
+            return [], last_id
+
+        entries = self.db.session \
+            .query(log_t.id, log_t.row_id, log_t.op, log_t.row_date) \
+            .filter(log_t.table_name == table) \
+            .filter(log_t.id > last_id) \
+            .order_by(log_t.id) \
+            .all()
+
+        if entries:
+            last_id = entries[-1][0]
+
+        return [tuple(entry[1:]) for entry in entries], last_id
+
+    def track_changes(self):
+        """
+        Follow the changelog to expire cached data and versions changed by
+        other processes, such as a backfill, since the previous call.
+        """
+
+        changes = {}
+
+        for table in TRACKED_TABLES:
+            changes[table], self.changes_seen[table] = \
+                self.changed_since(table, self.changes_seen.get(table))
+
+        for day in {row_date for _, _, row_date in changes['presence'] if row_date}:
+            self.cache.invalidate(('present', day))
+            self.versions.bump(('presence', day.year, day.month))
+
+        if changes['pv']:
+            self.invalidate_employees()
+            self.versions.bump('pv')
+
+        if changes['timetable']:
+            self.versions.bump('timetable')
+
+        if changes['acls']:
+            self.cache.invalidate('dept_modes')
+            self.versions.bump('acls')
+
+    def prune_changes(self, days):
+        """Forget changes older than given number of days."""
+
+        log_t = self.db.changelog
+        before = datetime.now() - timedelta(days=days)
+
+        pruned = log_t.filter(log_t.changed_at < before).delete(synchronize_session=False)
+        self.db.commit()
 
-        self.source_loop.start(3600)
-        self.elanor_loop.start(3600)
+        log.msg('Pruned {} changelog entries'.format(pruned))
+        return pruned
 
     def update_pvs(self, elanor):
-        pv_t = self.db.pv
+        """
+        Synchronize PVs with Elanor. Only contracts whose source payload
+        changed since the last run (according to the fingerprints kept in
+        `pv_source`) are parsed and written.
+        """
+
+        return self.store_contracts(elanor, elanor.get_contracts())
+
+    def store_contracts(self, elanor, contracts):
+        """Store `(oscpv, fingerprint, pv)` contracts that have changed."""
+
         emp_t = self.db.employee
+        pv_t = self.db.pv
+        src_t = self.db.pv_source
+
+        employees = {emp.emp_no: emp for emp in emp_t.all() if emp.emp_no}
+        known = {src.oscpv: src.fingerprint for src in src_t.all()}
+
+        changed = {}
+        touched = 0
+        moved = set()
 
-        departments = set()
-
-        for employee in emp_t.all():
-            log.msg('Checking pvs for {}'.format(employee.username))
-            for pv in elanor.get_pvs(employee.emp_no):
-                dept = str(pv['department'])
-                departments.add(dept)
-
-                valid = DateRange(
-                    lower=pv['validity'][0], upper=pv['validity'][1], bounds='[]')
-
-                query = and_(pv_t.pvid == pv['pvid'],
-                             pv_t.department == dept,
-                             pv_t.validity.overlaps(valid),
-                             pv_t.uid_employee == employee.uid)
-
-                if pv_t.filter(query) \
-                       .filter(pv_t.validity == valid) \
-                       .first():
-                    continue
-
-                if pv_t.filter(query).first():
-                    pv_t.filter(query).update(
-                        {'validity': valid, 'occupancy': pv['occupancy']}, synchronize_session=False)
-                else:
-                    pv_t.insert(**{
-                        'pvid': pv['pvid'],
-                        'occupancy': pv['occupancy'],
-                        'department': dept,
-                        'validity': valid,
-                        'uid_employee': employee.uid
-                    })
-
-        self.depts = sorted(list(departments))
+        for oscpv, fingerprint, pv in contracts:
+            employee = employees.get(oscpv.split('.')[0])
+
+            if employee is None or known.get(oscpv) == fingerprint:
+                continue
+
+            log.msg('Checking pvs for {} ({})'.format(employee.username, oscpv))
+            for item in elanor.get_items(pv):
+                if self.store_pv(item, employee):
+                    moved.add(employee.uid)
+                    touched += 1
+
+            changed[oscpv] = fingerprint
+
+        if moved:
+            # Changed validity of pvs invalidates their summaries
+            self.drop_summaries(moved)
+
+        if changed:
+            src = src_t._table
+            stmt = postgresql.insert(src).values([
+                {'oscpv': oscpv, 'fingerprint': fingerprint}
+                for oscpv, fingerprint in changed.items()
+            ])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[src.c.oscpv],
+                set_={'fingerprint': stmt.excluded.fingerprint})
+            self.db.session.execute(stmt)
+
+        departments = self.db.session.query(pv_t.department).distinct()
+        self.depts = sorted(str(dept) for dept, in departments)
         self.db.commit()
+        self.invalidate_employees()
+
+        if touched:
+            self.versions.bump('pv')
+
+        log.msg('Synced pvs from elanor: {} contracts changed, {} rows touched'.format(
+            len(changed), touched))
+
+        return touched
+
+    def store_pv(self, pv, employee):
+        """Insert or update a single PV item, returns number of rows touched."""
+
+        pv_t = self.db.pv
+        dept = str(pv['department'])
+
+        valid = DateRange(
+            lower=pv['validity'][0], upper=pv['validity'][1], bounds='[]')
+
+        query = and_(pv_t.pvid == pv['pvid'],
+                     pv_t.department == dept,
+                     pv_t.validity.overlaps(valid),
+                     pv_t.uid_employee == employee.uid)
+
+        if pv_t.filter(query) \
+               .filter(pv_t.validity == valid) \
+               .first():
+            return 0
+
+        if pv_t.filter(query).first():
+            pv_t.filter(query).update(
+                {'validity': valid, 'occupancy': pv['occupancy']}, synchronize_session=False)
+        else:
+            pv_t.insert(**{
+                'pvid': pv['pvid'],
+                'occupancy': pv['occupancy'],
+                'department': dept,
+                'validity': valid,
+                'uid_employee': employee.uid
+            })
+
+        return 1
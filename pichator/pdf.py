@@ -0,0 +1,119 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from collections import OrderedDict
+from threading import RLock, BoundedSemaphore
+from hashlib import sha1
+from werkzeug.exceptions import ServiceUnavailable
+from twisted.python import log
+
+from weasyprint import HTML
+from weasyprint.fonts import FontConfiguration
+
+__all__ = ['PdfRenderer']
+
+
+# Font configuration of a worker process, loaded once by `init_worker`.
+FONT_CONFIG = None
+
+
+def init_worker():
+    global FONT_CONFIG
+    FONT_CONFIG = FontConfiguration()
+
+
+def render_pdf(html):
+    return HTML(string=html).write_pdf(font_config=FONT_CONFIG)
+
+
+class PdfRenderer(object):
+    """
+    Renders HTML documents into PDF in a pool of worker processes, so
+    that layout does not hold the HTTP threads and the GIL for long.
+
+    At most `workers + queue_size` documents are rendered or waiting at
+    any time, further requests are rejected. Rendered documents are kept
+    in a LRU cache keyed by the caller supplied key and fingerprint of
+    the HTML, concurrent requests for the same document share one job.
+    """
+
+    def __init__(self, workers=2, queue_size=1, cache_size=64, timeout=120):
+        self.workers = workers
+        self.executor = self.make_executor()
+        self.slots = BoundedSemaphore(workers + queue_size)
+        self.timeout = timeout
+
+        self.lock = RLock()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.pending = {}
+
+    def make_executor(self):
+        # Workers are forked from a clean server process with WeasyPrint
+        # already imported, never from our multi-threaded process.
+        context = get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+
+        return ProcessPoolExecutor(self.workers, mp_context=context,
+                                   initializer=init_worker)
+
+    def render(self, key, html):
+        key = tuple(key) + (sha1(html.encode('utf-8')).hexdigest(),)
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+            future = self.pending.get(key)
+
+            if future is None:
+                if not self.slots.acquire(blocking=False):
+                    log.msg('PDF queue is full, rejecting {}.'.format(key[:-1]))
+                    raise ServiceUnavailable
+
+                # The slot is released by `finish` once there is a job.
+                try:
+                    future = self.submit(html)
+                except BaseException:
+                    self.slots.release()
+                    raise
+
+                self.pending[key] = future
+                future.add_done_callback(lambda f: self.finish(key, f))
+
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            log.msg('Rendering of PDF {} timed out.'.format(key[:-1]))
+            raise ServiceUnavailable
+
+    def submit(self, html):
+        try:
+            return self.executor.submit(render_pdf, html)
+        except BrokenProcessPool:
+            log.msg('PDF workers died, starting new ones.')
+            self.executor = self.make_executor()
+            return self.executor.submit(render_pdf, html)
+
+    def finish(self, key, future):
+        with self.lock:
+            del self.pending[key]
+            self.slots.release()
+
+            if future.cancelled() or future.exception() is not None:
+                return
+
+            self.cache[key] = future.result()
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# vim:set sw=4 ts=4 et:
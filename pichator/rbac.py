@@ -1,7 +1,8 @@
 #!/usr/bin/python3 -tt
 # -*- coding: utf-8 -*-
 
-from fnmatch import fnmatch
+from fnmatch import fnmatch, translate
+from functools import lru_cache
 
 import re
 
@@ -9,39 +10,55 @@ __all__ = ['AccessModel', 'AccessModelError']
 
 
 class AccessModel(object):
-    def __init__(self, items):
+    def __init__(self, items, cache_size=256):
         """Initialize the access model with `(privilege, pattern)` pairs."""
 
-        self.patterns = []
+        self.cache_size = cache_size
+        self.load(items)
+
+    def load(self, items):
+        """(Re)load the `(privilege, pattern)` pairs, dropping cached results."""
+
+        patterns = []
 
         for priv, pats in items:
             for pat in re.split(r'[ \t,]+', pats):
                 if not fnmatch(pat, '[+-]*'):
                     raise AccessModelError('invalid pattern: %r' % (pat,))
 
-                self.patterns.append((pat, priv))
+                patterns.append((pat[0] == '+', re.compile(translate(pat[1:])), priv))
+
+        self.patterns = patterns
+        self.roles_privileges = lru_cache(maxsize=self.cache_size)(self.resolve)
 
     def privileges(self, role):
         """Resolve a role to a set of application specific privileges."""
 
         privs = set()
 
-        for pat, priv in self.patterns:
-            if fnmatch(pat, '+*') and fnmatch(role, pat[1:]):
-                privs.add(priv)
-            elif fnmatch(pat, '-*') and fnmatch(role, pat[1:]):
-                privs.discard(priv)
+        for grant, regex, priv in self.patterns:
+            if regex.match(role):
+                if grant:
+                    privs.add(priv)
+                else:
+                    privs.discard(priv)
 
         return privs
 
+    def resolve(self, roles):
+        """Resolve a tuple of roles to a union of their privileges."""
+
+        privs = set()
+
+        for role in roles:
+            privs.update(self.privileges(role))
+
+        return frozenset(privs)
+
     def have_privilege(self, priv, roles):
         """Determine whether specified roles have given privilege."""
 
-        for role in roles or ['impotent']:
-            if priv in self.privileges(role):
-                return True
-
-        return False
+        return priv in self.roles_privileges(tuple(roles or ['impotent']))
 
 
 class AccessModelError(Exception):
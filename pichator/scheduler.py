@@ -0,0 +1,150 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from twisted.python.failure import Failure
+from twisted.python import log
+from collections import deque
+from random import uniform
+from time import time
+
+__all__ = ['Scheduler']
+
+
+class Job(object):
+    def __init__(self, name, fn, interval, retry, backoff_max, jitter, history):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.retry = retry
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.history = deque(maxlen=history)
+
+        # Start time of the current run or None
+        self.running = None
+
+        # Run was requested while running
+        self.again = False
+
+        self.failures = 0
+        self.coalesced = 0
+        self.call = None
+
+
+class Scheduler(object):
+    """
+    Runs periodic jobs returning Deferreds on the reactor.
+
+    The next run of a job is planned only once the previous one finishes,
+    so that runs of the same job never overlap; runs requested in the
+    meantime are coalesced into a single one. Failed runs are retried
+    with exponential backoff and timing of recent runs is kept around.
+    """
+
+    def __init__(self, clock=reactor, history=20):
+        self.clock = clock
+        self.history = history
+        self.jobs = {}
+        self.stopped = False
+
+    def add(self, name, fn, interval, retry=60, backoff_max=None, jitter=0.1, delay=0):
+        """
+        Run `fn` every `interval` seconds, first after `delay`. Failures
+        are retried after `retry` seconds, doubling up to `backoff_max`,
+        which defaults to four intervals. All delays are spread by the
+        `jitter` fraction to keep jobs from running in lockstep.
+        """
+
+        job = Job(name, fn, interval, retry, backoff_max or 4 * interval,
+                  jitter, self.history)
+
+        self.jobs[name] = job
+        job.call = self.clock.callLater(delay, self.run, job)
+        return job
+
+    def trigger(self, name):
+        """Run job now or right after the current run finishes."""
+
+        job = self.jobs[name]
+
+        if job.running is not None:
+            job.again = True
+            job.coalesced += 1
+            return
+
+        if job.call is not None and job.call.active():
+            job.call.cancel()
+
+        self.run(job)
+
+    def run(self, job):
+        job.call = None
+        job.running = time()
+
+        d = maybeDeferred(job.fn)
+        d.addBoth(self.finished, job)
+
+    def finished(self, result, job):
+        started, job.running = job.running, None
+
+        entry = {
+            'started': started,
+            'duration': time() - started,
+            'ok': not isinstance(result, Failure),
+        }
+
+        if entry['ok']:
+            job.failures = 0
+            delay = job.interval
+        else:
+            job.failures += 1
+            delay = min(job.retry * 2 ** (job.failures - 1), job.backoff_max)
+            entry['error'] = result.getErrorMessage()
+            log.err(result, 'Job {} failed {} times in a row, retrying in {}s'.format(
+                job.name, job.failures, int(delay)))
+
+        job.history.append(entry)
+
+        if self.stopped:
+            return
+
+        if job.again:
+            job.again = False
+            delay = 0
+        else:
+            delay *= uniform(1 - job.jitter, 1 + job.jitter)
+
+        job.call = self.clock.callLater(delay, self.run, job)
+
+    def status(self):
+        """Describe state of all jobs along with timing of recent runs."""
+
+        status = {}
+
+        for name, job in self.jobs.items():
+            call = job.call
+
+            status[name] = {
+                'interval': job.interval,
+                'running_since': job.running,
+                'failures': job.failures,
+                'coalesced': job.coalesced,
+                'next_run': call.getTime() if call is not None and call.active() else None,
+                'history': list(job.history),
+            }
+
+        return status
+
+    def stop(self):
+        self.stopped = True
+
+        for job in self.jobs.values():
+            if job.call is not None and job.call.active():
+                job.call.cancel()
+
+            job.call = None
+
+
+# vim:set sw=4 ts=4 et:
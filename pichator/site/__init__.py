@@ -8,7 +8,9 @@ from sqlalchemy.exc import *
 from werkzeug.exceptions import NotAcceptable, Forbidden, InternalServerError
 from pichator.site.util import *
 from functools import wraps
-from pichator.site.xlsx_export import xlsx_export
+from pichator.site.xlsx_export import xlsx_export, stream_file
+from pichator.workdays import CZ_CALENDAR
+from pichator.db import pool_status, release_sessions
 
 from sqlalchemy import desc
 from sqlalchemy.exc import SQLAlchemyError
@@ -21,20 +23,22 @@ from shutil import rmtree
 
 
 from twisted.python import log
-
-from weasyprint import HTML, CSS
-from weasyprint.fonts import FontConfiguration
+from twisted.internet import reactor
+from twisted.internet.threads import blockingCallFromThread
 
 from os.path import join, abspath, dirname
 from os import urandom
 
 import flask
 import re
-import holidays
 
 
+# Limits of a single workbook export
+EXPORT_MAX_MONTHS = 12
+EXPORT_MAX_SHEETS = 120
+
 
-def make_site(manager, access_model, debug=False):
+def make_site(manager, access_model, renderer, debug=False):
     app = flask.Flask('.'.join(__name__.split('.')[:-1]))
     app.secret_key = urandom(16)
     app.debug = debug
@@ -119,13 +123,15 @@ def make_site(manager, access_model, debug=False):
         }
         return '{} {}'.format(types[len(str(t))], t)
 
+    app.add_template_global(CZ_CALENDAR.is_workday, 'is_workday')
+    app.add_template_global(CZ_CALENDAR.working_days, 'working_days')
+
     @app.template_global('attendance_class')
     def attendance_row_class(day):
         date = day['date']
-        cz_holidays = holidays.CountryHoliday('CZ')
         today = date.today()
 
-        if date.weekday() in (5, 6) or date in cz_holidays:
+        if not CZ_CALENDAR.is_workday(date):
             return 'weekend'
 
         if date == today:
@@ -152,6 +158,14 @@ def make_site(manager, access_model, debug=False):
 
         return access_model.have_privilege(privilege, roles)
 
+    def directory():
+        """Employee directory snapshot shared by the whole request."""
+
+        if 'directory' not in flask.g:
+            flask.g.directory = manager.get_directory()
+
+        return flask.g.directory
+
     def pass_user_info(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
@@ -196,7 +210,7 @@ def make_site(manager, access_model, debug=False):
     @pass_user_info
     def index(uid, username, year, month, pvid):
         admin = has_privilege('admin')
-        acl = manager.get_acl(username)
+        acl = manager.get_acl(username, directory())
         today = date.today()
 
         year = year or today.year
@@ -209,9 +223,7 @@ def make_site(manager, access_model, debug=False):
         attendance = manager.get_attendance(uid, pvid, month, year, username, admin)
         
         # Restrictive mode - if one of your superiors blocked edit mode on any level of hierarchy you cant edit.
-        readonly = False
-        for i in range(1, 4):
-            readonly = readonly or manager.get_dept_mode(str(department)[:i]) == 'readonly'
+        readonly = manager.get_effective_dept_mode(department) == 'readonly'
 
         return flask.render_template('attendance.html', **locals())
 
@@ -219,17 +231,20 @@ def make_site(manager, access_model, debug=False):
     @authorized_only('user')
     @pass_user_info
     def employees(uid, username):
-        acl = manager.get_acl(username)
+        acl = manager.get_acl(username, directory())
         dept = flask.request.values.get('dept')
         period = flask.request.values.get('period').split('-')
-        return flask.jsonify(manager.get_employees(dept, int(period[0]), int(period[1])))
+        month, year = int(period[0]), int(period[1])
+
+        etag = manager.versions.token('pv', 'employee', scope=(dept, month, year))
+        return conditional_json(etag, lambda: manager.get_employees(dept, month, year))
     
     @app.route('/present', defaults={'day': None, 'month': None, 'year': None})
     @app.route('/present/<int:day>/<int:month>/<int:year>')
     @authorized_only('user')
     @pass_user_info
     def present(uid, username, day, month, year):
-        acl = manager.get_acl(username)
+        acl = manager.get_acl(username, directory())
         admin = has_privilege('admin')
         if not day or not month or not year:
             date_val = date.today()
@@ -247,53 +262,94 @@ def make_site(manager, access_model, debug=False):
     @authorized_only('user')
     @pass_user_info
     def display_dept(uid, username, dept, month, year):
-        acl = manager.get_acl(username)
+        acl = manager.get_acl(username, directory())
         admin = has_privilege('admin')
         today = date.today()
         month = month or today.month
         year = year or today.year
         dept = dept or acl
-        data = manager.get_department(dept, month, year)['data']
         pdf_view = flask.request.values.get('pdf') == 'true'
         xlsx_view = flask.request.values.get('xlsx') == 'true'
 
-        font_config = FontConfiguration()
         font_path = join(dirname(abspath(__file__)), '../templates/fonts')
 
-        if has_privilege('admin'):
-            if flask.request.method == 'POST':
-                new_mode = flask.request.form['modes']
-                manager.set_dept_mode(dept, new_mode)
-            mode = manager.get_dept_mode(dept)
+        if admin:
             acl = dept
-            data = manager.get_department(dept, month, year)['data']
-            if pdf_view:
-                pdf_template = HTML(string=flask.render_template('dept_pdf.html', **locals()))
-                result = pdf_template.write_pdf( font_config=font_config)
-                return flask.Response(response=result, mimetype='application/pdf')
-            if xlsx_view:
-                result = xlsx_export(**locals())
-                return flask.send_file(result, attachment_filename="dochazka-{dept}-{year}-{month}.xlsx".format(dept=dept, year=year, month=month), as_attachment=True)
-
-            return flask.render_template('attendance_department.html', **locals())
-
-        if not acl.isdigit():
+        elif not acl.isdigit():
             log.msg('User {} tried to access department view with acl {}.'.format(username, acl))
             raise Forbidden
+
         if flask.request.method == 'POST':
             new_mode = flask.request.form['modes']
             manager.set_dept_mode(acl, new_mode)
         mode = manager.get_dept_mode(acl)
-        if pdf_view:
-                pdf_template = HTML(string=flask.render_template('dept_pdf.html', **locals()))
-                result = pdf_template.write_pdf( font_config=font_config)
-                return flask.Response(response=result, mimetype='application/pdf')
+
         if xlsx_view:
-            result = xlsx_export(**locals())
-            return flask.send_file(result, attachment_filename="dochazka-{dept}-{year}-{month}.xlsx".format(dept=dept, year=year, month=month), as_attachment=True)
+            return export_dept(dept, acl, admin, year, month)
+
+        data = manager.get_department(dept, month, year)['data']
+
+        if pdf_view:
+            html = flask.render_template('dept_pdf.html', **locals())
+            result = renderer.render((dept, year, month), html)
+            return flask.Response(response=result, mimetype='application/pdf')
 
         return flask.render_template('attendance_department.html', **locals())
 
+    def export_dept(dept, acl, admin, year, month):
+        """
+        Send attendance of departments as a workbook. Optional `depts`
+        (comma separated) and `until` (month-year) request values extend
+        the export to more departments and months, one sheet for each.
+        """
+
+        depts = [dept]
+        if 'depts' in flask.request.values:
+            depts = flask.request.values['depts'].split(',')
+
+        # Every department gets a single sheet per month
+        depts = list(dict.fromkeys(d.strip() for d in depts if d.strip()))
+
+        if not depts or not all(d.isdigit() for d in depts):
+            log.err('Export with malformed departments {}.'.format(depts))
+            raise NotAcceptable
+
+        if not admin and not all(d.startswith(acl) for d in depts):
+            log.msg('Export of departments {} outside of acl {}.'.format(depts, acl))
+            raise Forbidden
+
+        until = flask.request.values.get('until', '{}-{}'.format(month, year)).split('-')
+        if len(until) != 2 or not all(part.isdigit() for part in until) \
+                or not 1 <= int(until[0]) <= 12:
+            log.err('Export with malformed until parameter.')
+            raise NotAcceptable
+
+        since = date(year, month, 1)
+        until = date(int(until[1]), int(until[0]), 1)
+        count = (until.year - since.year) * 12 + until.month - since.month + 1
+        if count < 1:
+            log.err('Export of empty period {} - {}.'.format(since, until))
+            raise NotAcceptable
+
+        if count > EXPORT_MAX_MONTHS or len(depts) * count > EXPORT_MAX_SHEETS:
+            log.msg('Export of {} departments over {} months refused.'.format(len(depts), count))
+            raise NotAcceptable
+
+        months = list(manager.month_starts(since, until))
+
+        # Departments are fetched one month at a time as sheets get written
+        sheets = ((d, m.year, m.month, manager.get_department(d, m.month, m.year)['data'])
+                  for d in depts for m in months)
+
+        name = 'dochazka-{dept}-{year}-{month}'.format(dept='_'.join(depts), year=year, month=month)
+        if until != since:
+            name += '-{year}-{month}'.format(year=until.year, month=until.month)
+
+        return flask.Response(
+            stream_file(xlsx_export(sheets)),
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            headers={'Content-Disposition': 'attachment; filename={}.xlsx'.format(name)})
+
 
     @app.route('/dept_data')
     @authorized_only('user')
@@ -304,7 +360,7 @@ def make_site(manager, access_model, debug=False):
             log.err(
                 'Geting data for department without mandatory parameter department number.')
             raise NotAcceptable
-        acl = manager.get_acl(username)
+        acl = manager.get_acl(username, directory())
         if acl != str(dept)[0] and not has_privilege(admin):
             log.err(
                 'Trying to acces data of department { }, but has no authorization to do so.'.format(dept))
@@ -313,7 +369,12 @@ def make_site(manager, access_model, debug=False):
         if len(period) != 2:
             today = date.today()
             period = (today.month, today.year)
-        return flask.jsonify(manager.get_department(dept, int(period[0]), int(period[1])))
+        month, year = int(period[0]), int(period[1])
+
+        # Days up to today are filled in differently
+        etag = manager.versions.token(('presence', year, month), 'timetable', 'pv', 'acls', 'employee',
+                                      scope=(dept, month, year, date.today()))
+        return conditional_json(etag, lambda: manager.get_department(dept, month, year))
 
     @app.route('/timetable', methods=['GET', 'POST'], defaults={'forced': None})
     @app.route('/timetable/<forced>', methods=['GET', 'POST'])
@@ -323,10 +384,10 @@ def make_site(manager, access_model, debug=False):
         admin = has_privilege('admin')
         if admin and forced is not None:
             username = forced
-        acl = manager.get_acl(username)
-        emp_no = manager.get_emp_no(username)
+        acl = manager.get_acl(username, directory())
+        emp_no = manager.get_emp_no(username, directory())
         employees = manager.get_all_employees()
-        emp_info = manager.get_emp_info(username)
+        emp_info = manager.get_emp_info(username, directory())
         if flask.request.method == 'GET':
             return flask.render_template('timetable.html', **locals())
         else:
@@ -341,12 +402,13 @@ def make_site(manager, access_model, debug=False):
     @authorized_only('admin')
     @pass_user_info
     def admin(uid, username):
-        acl = manager.get_acl(username)
+        acl = manager.get_acl(username, directory())
         admin = True
         if flask.request.method == 'POST':
             manager.set_acls(flask.request.form.to_dict())
+            flask.g.pop('directory', None)
         
-        acl = manager.get_acl(username)
+        acl = manager.get_acl(username, directory())
         employees = manager.get_all_employees()
         depts = manager.get_all_depts()
         
@@ -360,13 +422,16 @@ def make_site(manager, access_model, debug=False):
         admin = has_privilege('admin')
         if admin and forced is not None:
             username = forced
-            uid = manager.db.employee.filter_by(username=forced).first().uid
-        acl = manager.get_acl(username)
-        emp_no = manager.get_emp_no(username)
+            uid = manager.find_employee(forced, directory()).uid
+        acl = manager.get_acl(username, directory())
+        emp_no = manager.get_emp_no(username, directory())
         if not emp_no:
             log.err('Query for timetable data for employee who is not in database.')
             raise NotAcceptable
-        return flask.jsonify(manager.get_timetables(uid))
+
+        # Timetables valid today are returned
+        etag = manager.versions.token('timetable', 'pv', scope=(uid, date.today()))
+        return conditional_json(etag, lambda: manager.get_timetables(uid))
 
     @app.route('/pvs')
     @authorized_only('user')
@@ -378,20 +443,23 @@ def make_site(manager, access_model, debug=False):
             log.err('Query for list of PVs without required period parameter.')
             raise NotAcceptable
 
-        return flask.jsonify(manager.get_pvs(uid, int(period[0]), int(period[1])))
+        month, year = int(period[0]), int(period[1])
+
+        etag = manager.versions.token('pv', scope=(uid, month, year))
+        return conditional_json(etag, lambda: manager.get_pvs(uid, month, year))
 
     @app.route('/attendance_submit', methods=['POST'])
     @authorized_only('user')
     @pass_user_info
     def set_attendance_data(uid, username):
-        acl = manager.get_acl(username)
+        acl = manager.get_acl(username, directory())
         data = flask.request.get_json()
 
         user_uid = int(data.get('user_uid'))
 
         # check access
         if acl.isdigit() and uid != user_uid:
-            if not manager.is_supervisor(uid, user_uid):
+            if not manager.is_supervisor(uid, user_uid, directory()):
                 log.err('Submiting data for person not in your department.')
                 raise Forbidden
         elif uid != user_uid:
@@ -420,9 +488,28 @@ def make_site(manager, access_model, debug=False):
 
         return flask.jsonify(manager.set_attendance(date, user_uid, start, end, mode))
 
+    @app.route('/pool_status')
+    @authorized_only('admin')
+    def show_pool_status():
+        return flask.jsonify(pool_status())
+
+    @app.route('/sync_status', methods=['GET', 'POST'])
+    @authorized_only('admin')
+    def show_sync_status():
+        if flask.request.method == 'POST':
+            job = flask.request.values.get('job')
+            if job not in manager.scheduler.jobs:
+                log.err('Trigger of unknown sync job {}.'.format(job))
+                raise NotAcceptable
+
+            blockingCallFromThread(reactor, manager.scheduler.trigger, job)
+
+        # Scheduler lives in the reactor thread
+        return flask.jsonify(blockingCallFromThread(reactor, manager.scheduler.status))
+
     @app.teardown_appcontext
     def shutdown_session(exception=None):
-        manager.db.rollback()
+        release_sessions()
 
     return app
 
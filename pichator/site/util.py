@@ -1,11 +1,12 @@
 #!/usr/bin/python3 -tt
 # -*- coding: utf-8 -*-
 
-__all__ = ['internal_origin_only']
+__all__ = ['internal_origin_only', 'conditional_json']
 
 from urllib.parse import urlparse
 from functools import wraps
 from werkzeug.exceptions import Forbidden
+from gzip import compress
 
 import flask
 import re
@@ -33,4 +34,27 @@ def internal_origin_only(fn):
     return wrapper
 
 
-# vim:set sw=4 ts=4 et:
+def conditional_json(etag, compute, min_size=1024):
+    """
+    Respond with JSON payload returned by `compute` unless the client
+    already has the version identified by `etag`, in which case the
+    payload is not computed at all. Large bodies are gzipped.
+    """
+
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.jsonify(compute())
+
+        if len(response.data) >= min_size and 'gzip' in flask.request.accept_encodings:
+            response.data = compress(response.data)
+            response.headers['Content-Encoding'] = 'gzip'
+
+    # Same version is sent with different encodings
+    response.set_etag(etag, weak=True)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    return response
+
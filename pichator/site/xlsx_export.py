@@ -1,47 +1,71 @@
 import xlsxwriter
-from io import BytesIO
-from pprint import pprint as pp
+from calendar import monthrange
+from itertools import chain
+from tempfile import TemporaryFile
 
-def xlsx_export(data, dept, month, year, **kwargs):
-  output = BytesIO()
-  workbook = xlsxwriter.Workbook(output)
-  worksheet = workbook.add_worksheet(dept)
 
-  doc_name = 'Docházka za útvar {dept}'.format(dept=dept)
-  period = 'Za období: {month} - {year}'.format(month=month, year=year)
+def xlsx_export(sheets, output=None):
+  """
+  Write attendance into a workbook with one worksheet per item of the
+  `sheets` iterable of `(dept, year, month, data)`. Workbook is built in
+  constant memory mode, so only the sheet being written is kept around,
+  and goes into a temporary file unless `output` is given.
+  """
+
+  output = output or TemporaryFile()
+  workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
 
   # Add a bold format to use to highlight cells.
   bold = workbook.add_format({'bold': True})
 
-  if len(data) > 0:
-    worksheet.write('A1', doc_name, bold)
-    worksheet.write('A3', period)
-
-    # Column name
-    worksheet.write('A5', 'Číslo zaměstnance', bold)
-    worksheet.write('B5', 'Jméno zaměstnance', bold)
-
-    # Just the right amount of days in month
-    for date in range(1, len(data[0])-1):
-      worksheet.write(5, date+1, date, bold)
-
-    row = 6
-    col = 2
-    for emp in data:
-      worksheet.write(row, 0, emp['pvid'])
-      worksheet.write(row, 1, emp['name'])
-      for day in range(1, len(data[0])-1):
-        worksheet.write(row, col, emp.get(str(day), ''))
-        col += 1
-      col = 2
-      row += 1
-
-  else:
+  for dept, year, month, data in sheets:
+    name = '{dept} {year}-{month:02}'.format(dept=dept, year=year, month=month)
+    write_sheet(workbook.add_worksheet(name[:31]), bold, dept, year, month, data)
+
+  workbook.close()
+  output.seek(0)
+  return output
+
+
+def write_sheet(worksheet, bold, dept, year, month, data):
+  # Rows have to be written in order in constant memory mode.
+  data = iter(data)
+  first = next(data, None)
+
+  doc_name = 'Docházka za útvar {dept}'.format(dept=dept)
+  period = 'Za období: {month} - {year}'.format(month=month, year=year)
+
+  if first is None:
     worksheet.write('A5', 'Prázdná odpověď', bold)
     worksheet.write('A6', 'Dotaz vrátil prázdný záznam.')
     worksheet.write('A7', 'Žádný zaměstnanec tohoto útvaru nemá platný PV, nebo vyplněnou pracovní dobu.')
     worksheet.write('A8', 'Pokud si myslíte, že se jedná o chybu, kontaktujte prosím mailto:helpdeskict@techlib.cz')
+    return
 
-  workbook.close()
-  output.seek(0)
-  return output
+  worksheet.write('A1', doc_name, bold)
+  worksheet.write('A3', period)
+
+  # Column name
+  worksheet.write('A5', 'Číslo zaměstnance', bold)
+  worksheet.write('B5', 'Jméno zaměstnance', bold)
+
+  # Just the right amount of days in month
+  days = range(1, monthrange(year, month)[1] + 1)
+  worksheet.write_row(5, 2, days, bold)
+
+  row = 6
+  for emp in chain([first], data):
+    worksheet.write_row(row, 0, [emp['pvid'], emp['name']] +
+                        [emp.get(str(day), '') for day in days])
+    row += 1
+
+
+def stream_file(f, chunk_size=1 << 16):
+  """Yield contents of a file in chunks, closing it afterwards."""
+
+  with f:
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        break
+      yield chunk
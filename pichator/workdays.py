@@ -0,0 +1,126 @@
+#!/usr/bin/python3 -tt
+# -*- coding: utf-8 -*-
+
+from datetime import date
+from calendar import monthrange
+from threading import Lock
+import holidays
+
+__all__ = ['WorkCalendar', 'CZ_CALENDAR']
+
+
+HOLIDAY = 1
+WEEKEND = 2
+EVEN_WEEK = 4
+
+
+def day_flags(day, cz_holidays):
+    flag = 0
+
+    if day in cz_holidays:
+        flag |= HOLIDAY
+    if day.weekday() >= 5:
+        flag |= WEEKEND
+    if day.isocalendar()[1] % 2 == 0:
+        flag |= EVEN_WEEK
+
+    return flag
+
+
+class WorkCalendar:
+    """
+    Czech working calendar precomputed for a window of years.
+
+    Every day in the window is stored as a byte of flags indexed by its
+    distance from the first day, so that lookups do not need to consult
+    the holidays library. Days up to `slack` years outside of the window
+    extend the table, days even further away are computed on every lookup.
+    """
+
+    def __init__(self, first_year=None, last_year=None, slack=2):
+        year = date.today().year
+        self.lock = Lock()
+        self.slack = slack
+        self.build(first_year or year - 1, last_year or year + 1)
+
+    def build(self, first_year, last_year):
+        """Set the (inclusive) window of years and compute its table."""
+
+        self.window = (first_year, last_year)
+        self.compute(first_year, last_year)
+
+    def compute(self, first_year, last_year):
+
+        cz_holidays = holidays.Czech(years=range(first_year, last_year + 1))
+        origin = date(first_year, 1, 1).toordinal()
+        flags = bytearray()
+        working = {}
+
+        for ordinal in range(origin, date(last_year, 12, 31).toordinal() + 1):
+            day = date.fromordinal(ordinal)
+            flag = day_flags(day, cz_holidays)
+
+            if not flag & (HOLIDAY | WEEKEND):
+                key = (day.year, day.month)
+                working[key] = working.get(key, 0) + 1
+
+            flags.append(flag)
+
+        # Swap the whole table at once for readers in other threads
+        self.table = (first_year, last_year, origin, bytes(flags), working)
+
+    def flags(self, day):
+        first_year, last_year, origin, flags, _ = self.table
+
+        if not first_year <= day.year <= last_year:
+            if not self.extend(day.year):
+                return day_flags(day, holidays.Czech(years=[day.year]))
+
+            return self.flags(day)
+
+        return flags[day.toordinal() - origin]
+
+    def extend(self, year):
+        """Extend the table to given year unless it is too far away."""
+
+        low, high = self.window
+
+        if not low - self.slack <= year <= high + self.slack:
+            return False
+
+        with self.lock:
+            first_year, last_year = self.table[:2]
+            self.compute(min(first_year, year), max(last_year, year))
+
+        return True
+
+    def is_holiday(self, day):
+        return bool(self.flags(day) & HOLIDAY)
+
+    def is_weekend(self, day):
+        return bool(self.flags(day) & WEEKEND)
+
+    def is_workday(self, day):
+        return not self.flags(day) & (HOLIDAY | WEEKEND)
+
+    def is_even_week(self, day):
+        return bool(self.flags(day) & EVEN_WEEK)
+
+    def working_days(self, year, month):
+        """Number of working days in given month."""
+
+        first_year, last_year = self.table[:2]
+
+        if not first_year <= year <= last_year and not self.extend(year):
+            cz_holidays = holidays.Czech(years=[year])
+            days = (date(year, month, d + 1) for d in range(monthrange(year, month)[1]))
+            return sum(1 for d in days if not day_flags(d, cz_holidays) & (HOLIDAY | WEEKEND))
+
+        return self.table[4].get((year, month), 0)
+
+
+# Shared calendar, resized to the configured window on startup.
+CZ_CALENDAR = WorkCalendar()
+
+
+# vim:set sw=4 ts=4 et: